@@ -1,11 +1,13 @@
 from fastapi import FastAPI, HTTPException, Request, Response, Depends, UploadFile, File
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional, List
+from pydantic import BaseModel, Field, field_validator
+from typing import Optional, List, Dict, Tuple, AsyncIterator, Callable, Annotated
 from datetime import datetime, timezone, timedelta
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import CursorType, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError, OperationFailure
 from dotenv import load_dotenv
 import httpx
 import uuid
@@ -14,9 +16,31 @@ import csv
 import io
 import asyncio
 import json
+import hashlib
+import base64
+import bson
+import codecs
+import time
+import random
+import math
+import mmap
+import re
+import sys
+import unicodedata
+import zipfile
+import zlib
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from array import array
+from collections import OrderedDict, deque
 import jwt
 from jwt.algorithms import RSAAlgorithm
 
+try:
+    import msgpack
+except ImportError:  # Optional: only needed for the binary map format
+    msgpack = None
+
 load_dotenv()
 
 app = FastAPI(title="Map Your Friends API")
@@ -39,26 +63,351 @@ DB_NAME = os.environ.get("DB_NAME", "map_your_friends")
 client = AsyncIOMotorClient(MONGO_URL)
 db = client[DB_NAME]
 
+# None until the first transaction attempt tells us whether the deployment supports them
+_transactions_supported: Optional[bool] = None
+
+
+async def run_transaction(fn):
+    """Run `await fn(session)` in a transaction; standalone servers (no replica set) run it without one"""
+    global _transactions_supported
+    if _transactions_supported is not False:
+        async with await client.start_session() as session:
+            try:
+                async with session.start_transaction():
+                    result = await fn(session)
+                _transactions_supported = True
+                return result
+            except OperationFailure as e:
+                # IllegalOperation: "Transaction numbers are only allowed on a replica set member or mongos"
+                if e.code != 20:
+                    raise
+                print("WARNING: MongoDB transactions unavailable, falling back to idempotent writes")
+                _transactions_supported = False
+    return await fn(None)
+
 # Auth Utils
 CLERK_PEM_PUBLIC_KEY = os.environ.get("CLERK_PEM_PUBLIC_KEY")
 # If passing the key directly in env, it might need formatting. 
 # Alternatively, we can use JWKS URL. For now, assuming PEM is simpler for single service 
 # or allowing the user to provide it. 
-# If checking against JWKS URL is preferred, we'd use PyJWKClient.
+# If checking against JWKS URL is preferred, set CLERK_JWKS_URL (see JWKSKeySet below).
+CLERK_JWKS_URL = os.environ.get("CLERK_JWKS_URL")
+JWKS_REFRESH_INTERVAL = float(os.environ.get("JWKS_REFRESH_INTERVAL", "3600"))
+JWKS_REFRESH_JITTER = float(os.environ.get("JWKS_REFRESH_JITTER", "0.1"))
+# Minimum seconds between refetches triggered by a token with an unknown `kid`
+JWKS_UNKNOWN_KID_MIN_INTERVAL = float(os.environ.get("JWKS_UNKNOWN_KID_MIN_INTERVAL", "30"))
+
+# User documents are cached per process; the TTL bounds staleness across workers
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "30"))
+USER_CACHE_MAX_SIZE = int(os.environ.get("USER_CACHE_MAX_SIZE", "10000"))
+
+# Server-side clustering: cells are MAP_CLUSTER_RADIUS px wide on 256 px tiles;
+# above MAP_CLUSTER_MAX_ZOOM markers are returned individually
+MAP_CLUSTER_RADIUS = int(os.environ.get("MAP_CLUSTER_RADIUS", "64"))
+MAP_CLUSTER_MAX_ZOOM = int(os.environ.get("MAP_CLUSTER_MAX_ZOOM", "16"))
+
+# Snapshots older than this are rebuilt even without writes, healing any missed patch
+MAP_SNAPSHOT_MAX_AGE = float(os.environ.get("MAP_SNAPSHOT_MAX_AGE", "86400"))
+# Marker sets bigger than this (BSON bytes) aren't stored but read live each time;
+# well under MongoDB's 16 MB document limit to leave room for in-place patches
+MAP_SNAPSHOT_MAX_BYTES = int(os.environ.get("MAP_SNAPSHOT_MAX_BYTES", str(8 * 1024 * 1024)))
+
+# Push events: buffered events per stream before a slow consumer is cut off,
+# seconds between keepalive comments, and the cross-worker broker ("memory" or "mongo")
+EVENTS_QUEUE_SIZE = int(os.environ.get("EVENTS_QUEUE_SIZE", "100"))
+EVENTS_KEEPALIVE = float(os.environ.get("EVENTS_KEEPALIVE", "15"))
+EVENTS_BROKER = os.environ.get("EVENTS_BROKER", "memory")
+EVENTS_CAPPED_SIZE = int(os.environ.get("EVENTS_CAPPED_SIZE", str(16 * 1024 * 1024)))
+
+# User search: edge n-grams are stored up to SEARCH_MAX_GRAM characters per token,
+# and at most SEARCH_CANDIDATES index matches per match tier are ranked per query
+SEARCH_MAX_GRAM = int(os.environ.get("SEARCH_MAX_GRAM", "20"))
+SEARCH_CANDIDATES = int(os.environ.get("SEARCH_CANDIDATES", "200"))
+
+# Geocoding results are shared by all users: found places are kept GEOCODE_CACHE_TTL
+# seconds, unknown ones GEOCODE_NEGATIVE_TTL, with an in-process LRU in front
+GEOCODE_CACHE_TTL = float(os.environ.get("GEOCODE_CACHE_TTL", str(30 * 86400)))
+GEOCODE_NEGATIVE_TTL = float(os.environ.get("GEOCODE_NEGATIVE_TTL", "86400"))
+GEOCODE_MEMORY_CACHE_SIZE = int(os.environ.get("GEOCODE_MEMORY_CACHE_SIZE", "5000"))
+
+# Offline gazetteer: a GeoNames cities dump (.txt or .zip) compiled at startup into a
+# memory-mapped index next to it; unset to geocode through Nominatim only
+GAZETTEER_PATH = os.environ.get("GAZETTEER_PATH")
+GAZETTEER_MIN_POPULATION = int(os.environ.get("GAZETTEER_MIN_POPULATION", "0"))
+# Fuzzy (trigram) matches are only tried once Nominatim found nothing, must be at
+# least this similar, and skip trigrams listed for more than GAZETTEER_MAX_POSTINGS keys
+GAZETTEER_MIN_SIMILARITY = float(os.environ.get("GAZETTEER_MIN_SIMILARITY", "0.65"))
+GAZETTEER_MAX_POSTINGS = int(os.environ.get("GAZETTEER_MAX_POSTINGS", "20000"))
+
+# Background imports: workers per process, rows per write batch, seconds before an
+# unrenewed job lease lets another worker resume the job, idle poll interval
+IMPORT_WORKERS = int(os.environ.get("IMPORT_WORKERS", "2"))
+IMPORT_BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", "500"))
+IMPORT_LEASE_SECONDS = float(os.environ.get("IMPORT_LEASE_SECONDS", "120"))
+IMPORT_POLL_INTERVAL = float(os.environ.get("IMPORT_POLL_INTERVAL", "5"))
+# Claims of a job before it is marked failed, and seconds a finished job's rows
+# (raw CSV data included) are kept for its results before the TTL index drops them
+IMPORT_MAX_ATTEMPTS = int(os.environ.get("IMPORT_MAX_ATTEMPTS", "3"))
+IMPORT_ROWS_RETENTION = float(os.environ.get("IMPORT_ROWS_RETENTION", "86400"))
+
+# Uploads are parsed while streaming: bytes read per chunk, and bytes sampled
+# before the first decode to pick the text encoding
+IMPORT_READ_CHUNK = int(os.environ.get("IMPORT_READ_CHUNK", "65536"))
+IMPORT_ENCODING_SAMPLE = int(os.environ.get("IMPORT_ENCODING_SAMPLE", "4096"))
+# Lines a single CSV record may span before an unterminated quoted field is given up on
+IMPORT_MAX_RECORD_LINES = int(os.environ.get("IMPORT_MAX_RECORD_LINES", "100"))
+
+# Near-duplicate imported friends: trailing phone digits compared (ignores country
+# prefixes), max coordinate difference in degrees for two cities to count as the same
+DEDUP_PHONE_DIGITS = int(os.environ.get("DEDUP_PHONE_DIGITS", "9"))
+DEDUP_CITY_DEGREES = float(os.environ.get("DEDUP_CITY_DEGREES", "0.2"))
+
+# Upstream geocoding budget shared by all workers (Nominatim allows 1 req/s);
+# GEOCODE_RATE_LIMITER is "mongo" (cross-process bucket) or "local" (per process)
+GEOCODE_RATE = float(os.environ.get("GEOCODE_RATE", "1"))
+GEOCODE_BURST = float(os.environ.get("GEOCODE_BURST", "1"))
+GEOCODE_RATE_LIMITER = os.environ.get("GEOCODE_RATE_LIMITER", "mongo")
+
+# Batch geocoding: max cities + friend ids per request, and max distinct cities a
+# batch may resolve on the interactive lane (bigger batches queue as bulk work)
+GEOCODE_BATCH_MAX = int(os.environ.get("GEOCODE_BATCH_MAX", "500"))
+GEOCODE_BATCH_INTERACTIVE = int(os.environ.get("GEOCODE_BATCH_INTERACTIVE", "5"))
+
+# Outbound HTTP (Nominatim, JWKS) shares one pooled client
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.environ.get("HTTP_MAX_KEEPALIVE", "10"))
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", "10"))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+
+# Max number of verified session tokens kept in memory (0 disables the cache)
+TOKEN_CACHE_MAX_SIZE = int(os.environ.get("TOKEN_CACHE_MAX_SIZE", "10000"))
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries expire at an absolute epoch timestamp"""
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.time():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, expires_at: Optional[float] = None):
+        if self.max_size <= 0:
+            return
+        if expires_at is None and self.ttl is not None:
+            expires_at = time.time() + self.ttl
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def pop(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+# Created at startup and closed at shutdown; get_http_client() also builds it on demand
+http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """The process-wide pooled client, so connections (and TLS sessions) are reused"""
+    global http_client
+    if http_client is None or http_client.is_closed:
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE
+            ),
+            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            headers={"User-Agent": "MapYourFriends/1.0"}
+        )
+    return http_client
+
+
+def load_signing_key(pem: Optional[str]):
+    """Parse the PEM once at startup so jwt.decode gets a ready public key object"""
+    if not pem:
+        return None
+    try:
+        # Handle potential escaped newlines from env vars
+        return RSAAlgorithm(RSAAlgorithm.SHA256).prepare_key(pem.replace("\\n", "\n"))
+    except jwt.InvalidKeyError as e:
+        print(f"WARNING: CLERK_PEM_PUBLIC_KEY could not be parsed: {e}")
+        return None
+
+
+CLERK_SIGNING_KEY = load_signing_key(CLERK_PEM_PUBLIC_KEY)
+
+
+class SingleFlight:
+    """Collapses concurrent calls for the same key into one in-flight task, cancelled once nobody waits for it"""
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._waiters: Dict[asyncio.Task, int] = {}
+
+    def in_flight(self, key: str) -> bool:
+        return key in self._inflight
+
+    async def do(self, key: str, fn):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            # Shield so one cancelled caller doesn't cancel the call for everyone else
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+                # The last caller went away: stop the call instead of finishing it for nobody
+                task.cancel()
+
+    def _done(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # Mark as retrieved, waiters re-raise it themselves
+
+
+class JWKSKeySet:
+    """kid-indexed signing keys loaded from a JWKS URL or local file, refreshed in the background"""
+
+    def __init__(self, source: str, refresh_interval: float, jitter: float, unknown_kid_min_interval: float):
+        self.source = source
+        self.refresh_interval = refresh_interval
+        self.jitter = jitter
+        self.unknown_kid_min_interval = unknown_kid_min_interval
+        self.keys: Dict[Optional[str], object] = {}
+        self.last_refresh: Optional[datetime] = None
+        self._last_unknown_kid_refresh = 0.0
+        self._flight = SingleFlight()
+        self._task: Optional[asyncio.Task] = None
+
+    async def _fetch(self) -> dict:
+        if self.source.startswith(("http://", "https://")):
+            response = await get_http_client().get(self.source)
+            response.raise_for_status()
+            return response.json()
+        path = self.source[len("file://"):] if self.source.startswith("file://") else self.source
+        with open(path) as f:
+            return json.load(f)
+
+    async def _load(self):
+        jwks = await self._fetch()
+        keys = {}
+        for jwk in jwks.get("keys", []):
+            if jwk.get("kty") != "RSA" or jwk.get("use", "sig") != "sig":
+                continue
+            try:
+                keys[jwk.get("kid")] = RSAAlgorithm.from_jwk(jwk)
+            except jwt.InvalidKeyError as e:
+                print(f"Skipping invalid JWK {jwk.get('kid')}: {e}")
+        # Replace the whole dict at once so readers never see a partial key set
+        self.keys = keys
+        self.last_refresh = datetime.now(timezone.utc)
+
+    async def refresh(self):
+        await self._flight.do("jwks", self._load)
+
+    async def get_signing_key(self, kid: Optional[str]):
+        """Key for `kid`, refetching the set once (single-flight, rate limited) if it's unknown"""
+        key = self.keys.get(kid)
+        if key is not None:
+            return key
+        now = time.monotonic()
+        if self._flight.in_flight("jwks") or now - self._last_unknown_kid_refresh >= self.unknown_kid_min_interval:
+            self._last_unknown_kid_refresh = now
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"JWKS refresh error: {e}")
+        return self.keys.get(kid)
+
+    async def _refresh_loop(self):
+        while True:
+            delay = self.refresh_interval * (1 + random.uniform(-self.jitter, self.jitter))
+            await asyncio.sleep(max(delay, 1))
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"JWKS refresh error: {e}")
+
+    async def start(self):
+        try:
+            await self.refresh()
+        except Exception as e:
+            print(f"WARNING: initial JWKS load from {self.source} failed: {e}")
+        self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+
+jwks_key_set = JWKSKeySet(
+    CLERK_JWKS_URL, JWKS_REFRESH_INTERVAL, JWKS_REFRESH_JITTER, JWKS_UNKNOWN_KID_MIN_INTERVAL
+) if CLERK_JWKS_URL else None
+
+# sha256(token) -> verified payload, evicted when the token's `exp` passes
+verified_token_cache = TTLCache(TOKEN_CACHE_MAX_SIZE)
+
 
 async def verify_token(token: str):
+    token_digest = hashlib.sha256(token.encode()).hexdigest()
+    cached = verified_token_cache.get(token_digest)
+    if cached is not None:
+        return cached
+
     try:
         # In a real Clerk production app, you fetch the JWKS.
         # For simplicity/speed here if keys aren't set up, we decoded unverified IF AND ONLY IF valid keys are missing (DEV ONLY).
         # BUT we should really verify.
         
-        # Scenario 1: User provided CLERK_PEM_PUBLIC_KEY
-        if CLERK_PEM_PUBLIC_KEY:
-            # Handle potential escaped newlines from env vars
-            key = CLERK_PEM_PUBLIC_KEY.replace("\\n", "\n")
-            # Ensure headers/footers if missing? Clerk usually gives just the body?
-            # Standard PEM usually has -----BEGIN PUBLIC KEY-----
+        # Scenario 1: User provided CLERK_JWKS_URL and/or CLERK_PEM_PUBLIC_KEY
+        key = CLERK_SIGNING_KEY
+        if jwks_key_set is not None:
+            kid = jwt.get_unverified_header(token).get("kid")
+            key = await jwks_key_set.get_signing_key(kid) or CLERK_SIGNING_KEY
+            if key is None:
+                raise HTTPException(status_code=401, detail="Invalid token: unknown signing key")
+
+        if key is not None:
             payload = jwt.decode(token, key, algorithms=["RS256"], options={"verify_exp": True})
+            # Tokens without an expiry are never cached, we can't bound their lifetime
+            if isinstance(payload.get("exp"), (int, float)):
+                verified_token_cache.set(token_digest, payload, expires_at=payload["exp"])
             return payload
             
         # Scenario 2: No key provided? We can't verify signature securely without network call to JWKS.
@@ -66,7 +415,7 @@ async def verify_token(token: str):
         if os.environ.get("Unsafe_Skip_Verification") == "true":
              return jwt.decode(token, options={"verify_signature": False})
              
-        raise HTTPException(status_code=500, detail="Server Auth Config Missing (CLERK_PEM_PUBLIC_KEY)")
+        raise HTTPException(status_code=500, detail="Server Auth Config Missing (CLERK_JWKS_URL or CLERK_PEM_PUBLIC_KEY)")
         
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
@@ -75,6 +424,21 @@ async def verify_token(token: str):
 
 # ============== MODELS ==============
 
+# Coordinates are copied into 2dsphere-indexed GeoJSON points, which MongoDB
+# rejects outside these ranges: out-of-range input must be a 422, not a 500
+Latitude = Annotated[float, Field(ge=-90, le=90)]
+Longitude = Annotated[float, Field(ge=-180, le=180)]
+
+
+def valid_coordinates(lat, lng) -> bool:
+    """Whether an optional lat/lng pair is numeric and within range"""
+    for value, limit in ((lat, 90), (lng, 180)):
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not -limit <= value <= limit:
+            return False
+    return True
+
 class UserCreate(BaseModel):
     email: str
     name: str
@@ -83,11 +447,19 @@ class UserCreate(BaseModel):
 class UserUpdate(BaseModel):
     bio: Optional[str] = None
     active_city: Optional[str] = None
-    active_city_lat: Optional[float] = None
-    active_city_lng: Optional[float] = None
+    active_city_lat: Optional[Latitude] = None
+    active_city_lng: Optional[Longitude] = None
     competent_cities: Optional[List[dict]] = None
     availability: Optional[List[str]] = None
 
+    @field_validator("competent_cities")
+    @classmethod
+    def check_competent_coordinates(cls, cities: Optional[List[dict]]) -> Optional[List[dict]]:
+        for city in cities or []:
+            if not valid_coordinates(city.get("lat"), city.get("lng")):
+                raise ValueError("competent city coordinates out of range")
+        return cities
+
 class User(BaseModel):
     user_id: str
     email: str
@@ -107,8 +479,8 @@ class FriendRequest(BaseModel):
 class MeetupCreate(BaseModel):
     title: str
     city: str
-    city_lat: float
-    city_lng: float
+    city_lat: Latitude
+    city_lng: Longitude
     date: str
     description: Optional[str] = None
     invited_user_ids: Optional[List[str]] = []
@@ -118,6 +490,10 @@ class MessageCreate(BaseModel):
     content: str
     message_type: Optional[str] = "text"
 
+class MarkReadRequest(BaseModel):
+    cursor: Optional[str] = None  # message page cursor: mark read up to and including that message
+    up_to: Optional[datetime] = None
+
 class ImportedFriendCreate(BaseModel):
     first_name: str
     last_name: str
@@ -125,8 +501,8 @@ class ImportedFriendCreate(BaseModel):
     email: Optional[str] = None
     phone: Optional[str] = None
     photo: Optional[str] = None
-    city_lat: Optional[float] = None
-    city_lng: Optional[float] = None
+    city_lat: Optional[Latitude] = None
+    city_lng: Optional[Longitude] = None
     geocode_status: Optional[str] = "pending"  # pending, success, failed, manual
 
 class ImportedFriendUpdate(BaseModel):
@@ -136,10 +512,14 @@ class ImportedFriendUpdate(BaseModel):
     email: Optional[str] = None
     phone: Optional[str] = None
     photo: Optional[str] = None
-    city_lat: Optional[float] = None
-    city_lng: Optional[float] = None
+    city_lat: Optional[Latitude] = None
+    city_lng: Optional[Longitude] = None
     geocode_status: Optional[str] = None
 
+class GeocodeBatchRequest(BaseModel):
+    cities: List[str] = []
+    friend_ids: List[str] = []
+
 class GroupCreate(BaseModel):
     name: str
     color: Optional[str] = "#EC4899"  # Default pink
@@ -154,15 +534,193 @@ class GroupMemberAdd(BaseModel):
     member_id: str
     member_type: str  # "user" or "imported"
 
+# ============== GEO HELPERS ==============
+
+# GeoJSON copies of coordinates exist only for the 2dsphere indexes; keep them out of responses
+USER_PROJECTION = {"_id": 0, "active_location": 0, "competent_locations": 0}
+IMPORTED_PROJECTION = {"_id": 0, "location": 0, "fingerprint": 0, "block_keys": 0}
+MEETUP_PROJECTION = {"_id": 0, "location": 0}
+
+
+def parse_bbox(bbox: str) -> Tuple[float, float, float, float]:
+    """Parse "min_lng,min_lat,max_lng,max_lat"; min_lng > max_lng means the box crosses the antimeridian"""
+    try:
+        min_lng, min_lat, max_lng, max_lat = (float(v) for v in bbox.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox must be min_lng,min_lat,max_lng,max_lat")
+    if not (-90 <= min_lat <= max_lat <= 90 and -180 <= min_lng <= 180 and -180 <= max_lng <= 180):
+        raise HTTPException(status_code=400, detail="bbox out of range")
+    return min_lng, min_lat, max_lng, max_lat
+
+
+def point_in_bbox(lat: float, lng: float, bbox: Tuple[float, float, float, float]) -> bool:
+    min_lng, min_lat, max_lng, max_lat = bbox
+    if not min_lat <= lat <= max_lat:
+        return False
+    if min_lng <= max_lng:
+        return min_lng <= lng <= max_lng
+    return lng >= min_lng or lng <= max_lng
+
+
+def bounds_in_bbox(min_lat: float, min_lng: float, max_lat: float, max_lng: float,
+                   bbox: Tuple[float, float, float, float]) -> bool:
+    """Whether a lat/lng rectangle (not crossing the antimeridian) overlaps `bbox`"""
+    bbox_min_lng, bbox_min_lat, bbox_max_lng, bbox_max_lat = bbox
+    if max_lat < bbox_min_lat or min_lat > bbox_max_lat:
+        return False
+    if bbox_min_lng <= bbox_max_lng:
+        return max_lng >= bbox_min_lng and min_lng <= bbox_max_lng
+    return max_lng >= bbox_min_lng or min_lng <= bbox_max_lng
+
+
+def geo_point(lat: Optional[float], lng: Optional[float]) -> Optional[dict]:
+    """GeoJSON point for a lat/lng pair, None if either coordinate is missing"""
+    if lat is None or lng is None:
+        return None
+    return {"type": "Point", "coordinates": [lng, lat]}
+
+
+def geo_update(fields: dict) -> dict:
+    """Turn {field: point-or-None} into a $set/$unset update, None meaning remove"""
+    update = {}
+    to_set = {k: v for k, v in fields.items() if v is not None}
+    to_unset = {k: "" for k, v in fields.items() if v is None}
+    if to_set:
+        update["$set"] = to_set
+    if to_unset:
+        update["$unset"] = to_unset
+    return update
+
+
+def user_geo_fields(user: dict) -> dict:
+    return {
+        "active_location": geo_point(user.get("active_city_lat"), user.get("active_city_lng")),
+        "competent_locations": [
+            geo_point(c.get("lat"), c.get("lng")) for c in user.get("competent_cities") or []
+            if c.get("lat") is not None and c.get("lng") is not None
+        ] or None
+    }
+
+
+def bbox_geo_filter(bbox: Tuple[float, float, float, float]) -> Optional[dict]:
+    """$geoWithin filter for a viewport, None when it's too wide for a 2dsphere polygon.
+
+    2dsphere polygon edges are great-circle arcs, so the east-west edges are
+    densified to ~1 degree steps to stay close to the parallels. Callers still
+    post-filter with point_in_bbox.
+    """
+    min_lng, min_lat, max_lng, max_lat = bbox
+    width = max_lng - min_lng if min_lng <= max_lng else max_lng + 360 - min_lng
+    if width >= 180:
+        return None
+    steps = max(1, int(math.ceil(width)))
+    lngs = [min_lng + width * i / steps for i in range(steps + 1)]
+    lngs = [lng - 360 if lng > 180 else lng for lng in lngs]
+    ring = [[lng, min_lat] for lng in lngs] + [[lng, max_lat] for lng in reversed(lngs)]
+    ring.append(ring[0])
+    return {"$geoWithin": {"$geometry": {"type": "Polygon", "coordinates": [ring]}}}
+
 # ============== AUTH HELPERS ==============
 
+# user_id -> user document (without _id)
+user_cache = TTLCache(USER_CACHE_MAX_SIZE, ttl=USER_CACHE_TTL)
+
+
+async def get_user_doc(user_id: str) -> Optional[dict]:
+    """Read-through cached lookup of a user document"""
+    user = user_cache.get(user_id)
+    if user is None:
+        user = await db.users.find_one({"user_id": user_id}, USER_PROJECTION)
+        if user is None:
+            return None
+        user_cache.set(user_id, user)
+    # Shallow copy so handlers can't mutate the cached entry
+    return dict(user)
+
+
+# Fields embedded when a user is shown inside another resource (inbox senders, friend requests...)
+PROFILE_SUMMARY_FIELDS = ("user_id", "name", "email", "picture", "bio")
+PROFILE_SUMMARY_PROJECTION = {"_id": 0, **{field: 1 for field in PROFILE_SUMMARY_FIELDS}}
+
+
+class UserLoader:
+    """Request-scoped batch loader resolving user ids to profile summaries with one $in query"""
+
+    def __init__(self):
+        self._users: Dict[str, Optional[dict]] = {}
+
+    async def load_many(self, user_ids) -> Dict[str, dict]:
+        user_ids = list(dict.fromkeys(user_ids))
+        missing = []
+        for user_id in user_ids:
+            if user_id in self._users:
+                continue
+            cached = user_cache.get(user_id)
+            if cached is not None:
+                self._users[user_id] = {k: cached.get(k) for k in PROFILE_SUMMARY_FIELDS}
+            else:
+                missing.append(user_id)
+        if missing:
+            found = {
+                doc["user_id"]: doc
+                for doc in await db.users.find(
+                    {"user_id": {"$in": missing}}, PROFILE_SUMMARY_PROJECTION
+                ).to_list(None)
+            }
+            for user_id in missing:
+                self._users[user_id] = found.get(user_id)
+        # Copies so callers can't mutate the memoized entries
+        return {uid: dict(self._users[uid]) for uid in user_ids if self._users[uid] is not None}
+
+    async def load(self, user_id: str) -> Optional[dict]:
+        return (await self.load_many([user_id])).get(user_id)
+
+
+def get_user_loader(request: Request) -> UserLoader:
+    """Dependency returning the UserLoader memoized on the current request"""
+    loader = getattr(request.state, "user_loader", None)
+    if loader is None:
+        loader = request.state.user_loader = UserLoader()
+    return loader
+
+
+async def set_user_fields(user_id: str, fields: dict, geo: Optional[dict] = None) -> Optional[dict]:
+    """Write-through update of a user document, refreshing the cache entry"""
+    update = geo_update(geo or {})
+    update["$set"] = {**update.get("$set", {}), **fields}
+    user = await db.users.find_one_and_update(
+        {"user_id": user_id},
+        update,
+        projection=USER_PROJECTION,
+        return_document=ReturnDocument.AFTER
+    )
+    if user is None:
+        user_cache.pop(user_id)
+        return None
+    user_cache.set(user_id, user)
+    if "name" in fields or "email" in fields:
+        await index_user_for_search(user)
+    return dict(user)
+
+
 async def get_current_user(request: Request) -> dict:
     """Get current user from Bearer Token"""
     auth_header = request.headers.get("Authorization")
     if not auth_header or not auth_header.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
     
-    token = auth_header.split(" ")[1]
+    return await user_for_token(auth_header.split(" ")[1])
+
+
+async def get_stream_user(request: Request) -> dict:
+    """Like get_current_user, also accepting ?token= since EventSource can't send headers"""
+    if not request.headers.get("Authorization") and request.query_params.get("token"):
+        return await user_for_token(request.query_params["token"])
+    return await get_current_user(request)
+
+
+async def user_for_token(token: str) -> dict:
+    """Verify a session token and load (or create on first login) its user"""
     payload = await verify_token(token)
     
     # Clerk User ID is in 'sub'
@@ -173,7 +731,7 @@ async def get_current_user(request: Request) -> dict:
     
     # Check if user exists in OUR db
     # We map 'user_id' in our DB to the Clerk ID (sub)
-    user = await db.users.find_one({"user_id": clerk_user_id}, {"_id": 0})
+    user = await get_user_doc(clerk_user_id)
     
     if not user:
         # Create user on the fly (first login)
@@ -193,11 +751,272 @@ async def get_current_user(request: Request) -> dict:
             "availability": [],
             "created_at": datetime.now(timezone.utc)
         }
-        await db.users.insert_one(user_data)
-        user = user_data
+        # Upsert so concurrent first requests can't insert the same user twice
+        try:
+            user = await db.users.find_one_and_update(
+                {"user_id": clerk_user_id},
+                {"$setOnInsert": user_data},
+                upsert=True,
+                projection=USER_PROJECTION,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Lost the race against another worker's upsert; its document wins
+            user = await db.users.find_one({"user_id": clerk_user_id}, USER_PROJECTION)
+        user_cache.set(clerk_user_id, user)
+        await index_user_for_search(user)
+        user = dict(user)
     
     return user
 
+# ============== PAGINATION HELPERS ==============
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def page_size(limit: Optional[int]) -> int:
+    if limit is None:
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def encode_cursor(values: dict) -> str:
+    """Opaque cursor holding the sort key of the last item of a page"""
+    raw = json.dumps(values, separators=(",", ":"), default=lambda v: v.isoformat())
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> dict:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, dict):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+
+def cursor_datetime(value) -> datetime:
+    try:
+        return datetime.fromisoformat(value)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+# ============== CONDITIONAL GET ==============
+#
+# data_versions holds one counter per user and scope ("map", "groups", "inbox"),
+# bumped after every write that changes what that user's endpoints return. ETags
+# are derived from it, so a matching If-None-Match is answered with a 304 from
+# one primary-key read, before the handler runs.
+
+
+async def bump_data_versions(user_ids: List[str], *scopes: str):
+    if not user_ids:
+        return
+    await db.data_versions.bulk_write([
+        UpdateOne({"_id": user_id}, {"$inc": {scope: 1 for scope in scopes}}, upsert=True)
+        for user_id in set(user_ids)
+    ], ordered=False)
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    # If-None-Match uses weak comparison
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+def conditional_get(scope: str, cache_control: str):
+    """Dependency adding an ETag for the user's `scope` version, short-circuiting with 304 on a match
+
+    Every route states its own Cache-Control."""
+    async def dependency(request: Request, response: Response, user: dict = Depends(get_current_user)):
+        versions = await db.data_versions.find_one({"_id": user["user_id"]}, {scope: 1})
+        version = (versions or {}).get(scope, 0)
+        # Query parameters (bbox, pagination, format...) and Accept select a different representation
+        accept = request.headers.get("Accept", "")
+        variant = hashlib.sha1(f"{user['user_id']}?{request.url.query}|{accept}".encode()).hexdigest()[:12]
+        etag = f'"{scope}-{version}-{variant}"'
+        headers = {"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept"}
+        if etag_matches(request.headers.get("If-None-Match"), etag):
+            raise HTTPException(status_code=304, headers=headers)
+        response.headers.update(headers)
+        # Handlers returning their own Response (e.g. compact map formats) copy these
+        request.state.conditional_headers = headers
+    return dependency
+
+# ============== PUSH EVENTS ==============
+#
+# Handlers publish events for a set of users through `event_broker`; every worker's
+# broker hands them to its local `event_hub`, which fans them out to the open
+# /api/events streams of those users. InProcessBroker is enough for one worker;
+# EVENTS_BROKER=mongo relays through a capped collection tailed by all workers.
+
+# Sent to a stream whose queue overflowed; the client should refetch and reconnect
+RESYNC_EVENT = {"id": None, "type": "resync", "data": {}}
+
+
+class PubSubHub:
+    """Local fan-out of events to per-connection bounded queues"""
+
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self.delivered = 0
+        self.overflows = 0
+        self._subscribers: Dict[str, set] = {}
+
+    def subscribe(self, user_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.setdefault(user_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: str, queue: asyncio.Queue):
+        queues = self._subscribers.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[user_id]
+
+    def deliver(self, user_ids: List[str], event: dict):
+        for user_id in user_ids:
+            for queue in list(self._subscribers.get(user_id, ())):
+                try:
+                    queue.put_nowait(event)
+                    self.delivered += 1
+                except asyncio.QueueFull:
+                    # Slow consumer: drop its backlog and end the stream with a resync
+                    self.overflows += 1
+                    while not queue.empty():
+                        queue.get_nowait()
+                    queue.put_nowait(RESYNC_EVENT)
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._subscribers),
+            "connections": sum(len(queues) for queues in self._subscribers.values()),
+            "delivered": self.delivered,
+            "overflows": self.overflows
+        }
+
+
+class Broker(ABC):
+    """Carries published events to the hub of every worker"""
+
+    def __init__(self):
+        self._deliver: Optional[Callable[[List[str], dict], None]] = None
+
+    async def start(self, deliver: Callable[[List[str], dict], None]):
+        self._deliver = deliver
+
+    async def stop(self):
+        pass
+
+    @abstractmethod
+    async def publish(self, user_ids: List[str], event: dict):
+        """Hand an event for `user_ids` to every worker's hub"""
+
+
+class InProcessBroker(Broker):
+    """Single-worker broker: delivers straight to the local hub"""
+
+    async def publish(self, user_ids: List[str], event: dict):
+        self._deliver(user_ids, event)
+
+
+class MongoBroker(Broker):
+    """Multi-worker broker: events go through a capped collection every worker tails"""
+
+    def __init__(self, collection: str, size: int):
+        super().__init__()
+        self.collection = collection
+        self.size = size
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, deliver):
+        await super().start(deliver)
+        try:
+            await db.create_collection(self.collection, capped=True, size=self.size)
+        except CollectionInvalid:
+            pass
+        self._task = asyncio.create_task(self._tail())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def publish(self, user_ids: List[str], event: dict):
+        await db[self.collection].insert_one({"user_ids": user_ids, "event": event})
+
+    async def _tail(self):
+        # Only events published after startup are relayed
+        newest = await db[self.collection].find_one({}, {"_id": 1}, sort=[("$natural", -1)])
+        last_id = newest["_id"] if newest else None
+        while True:
+            try:
+                cursor = db[self.collection].find(
+                    {"_id": {"$gt": last_id}} if last_id else {},
+                    cursor_type=CursorType.TAILABLE_AWAIT
+                )
+                async for doc in cursor:
+                    last_id = doc["_id"]
+                    self._deliver(doc["user_ids"], doc["event"])
+            except Exception as e:
+                print(f"WARNING: event broker tail failed: {e}")
+            # A tailable cursor dies on an empty collection; retry shortly
+            await asyncio.sleep(1)
+
+
+event_hub = PubSubHub(EVENTS_QUEUE_SIZE)
+event_broker: Broker = MongoBroker("events", EVENTS_CAPPED_SIZE) if EVENTS_BROKER == "mongo" else InProcessBroker()
+
+
+async def publish_event(user_ids, event_type: str, data: dict):
+    """Push an event to the users' open streams; a failure never fails the calling request"""
+    event = {"id": uuid.uuid4().hex[:12], "type": event_type, "data": data}
+    try:
+        await event_broker.publish(list(user_ids), event)
+    except Exception as e:
+        print(f"WARNING: could not publish {event_type} event: {e}")
+
+
+def format_sse(event: dict) -> str:
+    data = json.dumps(event["data"], separators=(",", ":"), default=lambda v: v.isoformat())
+    event_id = f"id: {event['id']}\n" if event["id"] else ""
+    return f"{event_id}event: {event['type']}\ndata: {data}\n\n"
+
+
+@app.get("/api/events")
+async def event_stream(request: Request, user: dict = Depends(get_stream_user)):
+    """Server-Sent Events stream of the user's notifications"""
+    queue = event_hub.subscribe(user["user_id"])
+
+    async def stream():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), EVENTS_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_sse(event)
+                if event["type"] == "resync":
+                    break
+        finally:
+            event_hub.unsubscribe(user["user_id"], queue)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # ============== AUTH ENDPOINTS ==============
 
 @app.get("/api/auth/me")
@@ -214,122 +1033,379 @@ async def get_me(user: dict = Depends(get_current_user)):
 async def update_user(update: UserUpdate, user: dict = Depends(get_current_user)):
     """Update current user profile"""
     update_data = {k: v for k, v in update.model_dump().items() if v is not None}
-    if update_data:
-        await db.users.update_one(
-            {"user_id": user["user_id"]},
-            {"$set": update_data}
-        )
-    updated_user = await db.users.find_one({"user_id": user["user_id"]}, {"_id": 0})
+    if not update_data:
+        return user
+    # Keep the indexed GeoJSON copies in sync with whatever coordinates changed
+    geo = {}
+    if "active_city_lat" in update_data or "active_city_lng" in update_data:
+        geo["active_location"] = user_geo_fields({**user, **update_data})["active_location"]
+    if "competent_cities" in update_data:
+        geo["competent_locations"] = user_geo_fields(update_data)["competent_locations"]
+    updated_user = await set_user_fields(user["user_id"], update_data, geo)
+    friend_ids = await get_friend_ids(user["user_id"])
+    await patch_map_snapshots(friend_ids, f"u:{user['user_id']}", friend_snapshot_entry(updated_user))
+    # Inboxes embed this profile as from_user: anyone this user has exchanged
+    # messages with, friend or not
+    partner_ids = [
+        user_id for user_id in await db.conversations.distinct("user_ids", {"user_ids": user["user_id"]})
+        if user_id != user["user_id"]
+    ]
+    await bump_data_versions(partner_ids, "inbox")
     return updated_user
 
 @app.get("/api/users/{user_id}")
 async def get_user(user_id: str, current_user: dict = Depends(get_current_user)):
     """Get user by ID"""
-    user = await db.users.find_one({"user_id": user_id}, {"_id": 0})
+    user = await get_user_doc(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return user
 
-# ============== FRIENDS ENDPOINTS ==============
+# ============== MAP MARKERS ==============
 
-@app.get("/api/friends")
-async def get_friends(user: dict = Depends(get_current_user)):
-    """Get all friends of current user"""
-    friendships = await db.friendships.find(
-        {"$or": [{"user_id": user["user_id"]}, {"friend_id": user["user_id"]}], "status": "accepted"},
-        {"_id": 0}
-    ).to_list(1000)
-    
-    friend_ids = []
-    for f in friendships:
-        if f["user_id"] == user["user_id"]:
-            friend_ids.append(f["friend_id"])
-        else:
-            friend_ids.append(f["user_id"])
-    
-    friends = await db.users.find(
-        {"user_id": {"$in": friend_ids}},
-        {"_id": 0}
-    ).to_list(1000)
-    
-    return friends
+# Fields of a friend / imported friend needed to draw its markers
+FRIEND_MARKER_FIELDS = (
+    "user_id", "name", "picture", "bio", "active_city", "active_city_lat",
+    "active_city_lng", "competent_cities", "availability"
+)
+IMPORTED_MARKER_FIELDS = (
+    "friend_id", "first_name", "last_name", "city", "city_lat", "city_lng",
+    "email", "phone", "photo", "geocode_status"
+)
 
-@app.get("/api/friends/map")
-async def get_friends_for_map(user: dict = Depends(get_current_user)):
-    """Get friends with location data for map"""
-    friends = await get_friends(user)
-    map_data = []
-    for friend in friends:
-        if friend.get("active_city_lat") and friend.get("active_city_lng"):
-            map_data.append({
+
+def active_friend_marker(friend: dict) -> Optional[dict]:
+    if not (friend.get("active_city_lat") and friend.get("active_city_lng")):
+        return None
+    return {
+        "user_id": friend["user_id"],
+        "name": friend["name"],
+        "picture": friend.get("picture"),
+        "bio": friend.get("bio"),
+        "active_city": friend.get("active_city"),
+        "lat": friend["active_city_lat"],
+        "lng": friend["active_city_lng"],
+        "competent_cities": friend.get("competent_cities", []),
+        "availability": friend.get("availability", []),
+        "marker_type": "active"
+    }
+
+
+def competent_friend_markers(friend: dict) -> List[dict]:
+    markers = []
+    for city in friend.get("competent_cities") or []:
+        if city.get("lat") and city.get("lng"):
+            markers.append({
                 "user_id": friend["user_id"],
                 "name": friend["name"],
                 "picture": friend.get("picture"),
                 "bio": friend.get("bio"),
-                "active_city": friend.get("active_city"),
-                "lat": friend["active_city_lat"],
-                "lng": friend["active_city_lng"],
-                "competent_cities": friend.get("competent_cities", []),
+                "city_name": city.get("name"),
+                "lat": city["lat"],
+                "lng": city["lng"],
                 "availability": friend.get("availability", []),
-                "marker_type": "active"
+                "marker_type": "competent"
             })
-        for city in friend.get("competent_cities", []):
-            if city.get("lat") and city.get("lng"):
-                map_data.append({
-                    "user_id": friend["user_id"],
-                    "name": friend["name"],
-                    "picture": friend.get("picture"),
-                    "bio": friend.get("bio"),
-                    "city_name": city.get("name"),
-                    "lat": city["lat"],
-                    "lng": city["lng"],
-                    "availability": friend.get("availability", []),
-                    "marker_type": "competent"
-                })
+    return markers
+
+
+def imported_friend_marker(friend: dict) -> dict:
+    return {
+        "friend_id": friend["friend_id"],
+        "name": f"{friend['first_name']} {friend.get('last_name', '')}".strip(),
+        "city": friend["city"],
+        "lat": friend["city_lat"],
+        "lng": friend["city_lng"],
+        "email": friend.get("email"),
+        "phone": friend.get("phone"),
+        "photo": friend.get("photo"),
+        "geocode_status": friend.get("geocode_status", "success"),
+        "marker_type": "imported"
+    }
+
+
+def grouped_map_markers(friends: List[dict], imported: List[dict], groups: List[dict]) -> List[dict]:
+    """Active-city and imported markers tagged with the owner's groups"""
+    # Create lookup dictionaries
+    user_groups = {}  # user_id -> [group_info]
+    imported_groups = {}  # friend_id -> [group_info]
+    
+    for group in groups:
+        group_info = {
+            "group_id": group["group_id"],
+            "name": group["name"],
+            "color": group["color"]
+        }
+        for uid in group.get("member_ids", []):
+            user_groups.setdefault(uid, []).append(group_info)
+        for fid in group.get("imported_member_ids", []):
+            imported_groups.setdefault(fid, []).append(group_info)
+
+    map_data = []
+    for friend in friends:
+        marker = active_friend_marker(friend)
+        if marker:
+            friend_groups = user_groups.get(friend["user_id"], [])
+            marker["groups"] = friend_groups
+            marker["marker_color"] = friend_groups[0]["color"] if friend_groups else None
+            map_data.append(marker)
+    
+    for friend in imported:
+        marker = imported_friend_marker(friend)
+        friend_groups = imported_groups.get(friend["friend_id"], [])
+        marker["groups"] = friend_groups
+        marker["marker_color"] = friend_groups[0]["color"] if friend_groups else None
+        map_data.append(marker)
+    
     return map_data
 
+# ============== COMPACT MAP FORMAT ==============
+#
+# Opt-in encoding for map marker lists, chosen with ?format=compact|msgpack or an
+# Accept of COMPACT_MEDIA_TYPE / MSGPACK_MEDIA_TYPE:
+#
+#   {"format": "compact-v1", "count": N,
+#    "coords": float32 little-endian [lat0, lng0, lat1, lng1, ...] (base64 in JSON, raw bytes in msgpack),
+#    "profile": [profile row index per marker],
+#    "type": [index into "types" per marker], "types": ["active", ...],
+#    "city_name": [per-marker city name or null],
+#    "profiles": {"fields": [...], "rows": [[...], ...]},   one row per friend / imported friend
+#    "groups": [{"group_id", "name", "color"}, ...]}        profile "groups" values are indices into this
+#
+# A friend with several competent cities therefore appears once in "profiles".
+
+COMPACT_MEDIA_TYPE = "application/vnd.mapyourfriends.compact+json"
+MSGPACK_MEDIA_TYPE = "application/x-msgpack"
+
+# Marker keys that vary per marker; everything else belongs to the profile
+PER_MARKER_FIELDS = ("lat", "lng", "marker_type", "city_name")
+
+
+def requested_map_format(request: Request) -> str:
+    fmt = request.query_params.get("format")
+    if fmt:
+        if fmt not in ("json", "compact", "msgpack"):
+            raise HTTPException(status_code=400, detail="format must be json, compact or msgpack")
+        return fmt
+    accept = request.headers.get("Accept", "")
+    if MSGPACK_MEDIA_TYPE in accept or "application/msgpack" in accept:
+        return "msgpack"
+    if COMPACT_MEDIA_TYPE in accept:
+        return "compact"
+    return "json"
+
+
+def encode_compact_markers(markers: List[dict]) -> dict:
+    coords = array("f")
+    profile_index = {}  # ("u"|"i", id) -> row
+    profile_rows = []
+    fields = []
+    field_pos = {}
+    type_index = {}
+    group_index = {}
+    groups = []
+    marker_profiles, marker_types, city_names = [], [], []
+
+    for marker in markers:
+        coords.append(marker["lat"])
+        coords.append(marker["lng"])
+        marker_type = marker.get("marker_type")
+        marker_types.append(type_index.setdefault(marker_type, len(type_index)))
+        city_names.append(marker.get("city_name"))
+
+        identity = ("u", marker["user_id"]) if "user_id" in marker else ("i", marker.get("friend_id"))
+        row = profile_index.get(identity)
+        if row is None:
+            values = {}
+            for key, value in marker.items():
+                if key in PER_MARKER_FIELDS:
+                    continue
+                if key == "groups":
+                    refs = []
+                    for group in value:
+                        if group["group_id"] not in group_index:
+                            group_index[group["group_id"]] = len(groups)
+                            groups.append(group)
+                        refs.append(group_index[group["group_id"]])
+                    value = refs
+                if key not in field_pos:
+                    field_pos[key] = len(fields)
+                    fields.append(key)
+                values[key] = value
+            row = profile_index[identity] = len(profile_rows)
+            profile_rows.append(values)
+        marker_profiles.append(row)
+
+    if sys.byteorder != "little":
+        coords.byteswap()
+    return {
+        "format": "compact-v1",
+        "count": len(markers),
+        "coords": coords.tobytes(),
+        "profile": marker_profiles,
+        "type": marker_types,
+        "types": list(type_index),
+        "city_name": city_names,
+        "profiles": {"fields": fields, "rows": [[r.get(f) for f in fields] for r in profile_rows]},
+        "groups": groups
+    }
+
+
+def map_response(request: Request, markers: List[dict]):
+    """Markers as-is for JSON clients, or a compact Response when one was negotiated"""
+    fmt = requested_map_format(request)
+    if fmt == "json":
+        return markers
+    headers = getattr(request.state, "conditional_headers", {})
+    payload = encode_compact_markers(markers)
+    if fmt == "msgpack":
+        if msgpack is None:
+            raise HTTPException(status_code=406, detail="msgpack format is not available on this server")
+        content = msgpack.packb(payload, default=lambda v: v.isoformat())
+        return Response(content=content, media_type=MSGPACK_MEDIA_TYPE, headers=headers)
+    payload["coords"] = base64.b64encode(payload["coords"]).decode()
+    content = json.dumps(payload, separators=(",", ":"), default=lambda v: v.isoformat())
+    return Response(content=content, media_type=COMPACT_MEDIA_TYPE, headers=headers)
+
+# ============== FRIENDS ENDPOINTS ==============
+
+def friendship_pair_key(user_a: str, user_b: str) -> str:
+    """Order-independent key identifying the friendship between two users"""
+    return "|".join(sorted((user_a, user_b)))
+
+
+async def add_friend_edges(user_a: str, user_b: str, session=None):
+    """Insert both directed adjacency edges for an accepted friendship (idempotent)"""
+    now = datetime.now(timezone.utc)
+    await db.friend_edges.bulk_write([
+        UpdateOne(
+            {"owner_id": owner_id, "friend_id": friend_id},
+            {"$setOnInsert": {"owner_id": owner_id, "friend_id": friend_id, "created_at": now}},
+            upsert=True
+        )
+        for owner_id, friend_id in ((user_a, user_b), (user_b, user_a))
+    ], session=session)
+
+
+async def remove_friend_edges(user_a: str, user_b: str, session=None):
+    await db.friend_edges.delete_many({"$or": [
+        {"owner_id": user_a, "friend_id": user_b},
+        {"owner_id": user_b, "friend_id": user_a}
+    ]}, session=session)
+
+
+async def get_friend_ids(user_id: str) -> List[str]:
+    """Ids of all accepted friends, read from the user's adjacency edges"""
+    edges = await db.friend_edges.find(
+        {"owner_id": user_id},
+        {"_id": 0, "friend_id": 1}
+    ).to_list(None)
+    return [e["friend_id"] for e in edges]
+
+
+async def load_friend_users(user_id: str, bbox: Optional[Tuple[float, float, float, float]] = None) -> List[dict]:
+    """User documents of all friends, optionally only those with a location inside `bbox`"""
+    friend_ids = await get_friend_ids(user_id)
+    if not friend_ids:
+        return []
+    query = {"user_id": {"$in": friend_ids}}
+    geo_filter = bbox_geo_filter(bbox) if bbox else None
+    if geo_filter:
+        query["$or"] = [{"active_location": geo_filter}, {"competent_locations": geo_filter}]
+    return await db.users.find(query, USER_PROJECTION).to_list(None)
+
+
+@app.get("/api/friends")
+async def get_friends(user: dict = Depends(get_current_user), limit: Optional[int] = None, after: Optional[str] = None):
+    """Get friends of current user; `limit`/`after` switch to a cursor-paginated page"""
+    if limit is None and after is None:
+        return await load_friend_users(user["user_id"])
+
+    # Keyset page over the (owner_id, friend_id) edge index
+    size = page_size(limit)
+    query = {"owner_id": user["user_id"]}
+    if after:
+        query["friend_id"] = {"$gt": decode_cursor(after).get("friend_id", "")}
+    edges = await db.friend_edges.find(
+        query,
+        {"_id": 0, "friend_id": 1}
+    ).sort("friend_id", 1).limit(size + 1).to_list(None)
+    has_more = len(edges) > size
+    friend_ids = [e["friend_id"] for e in edges[:size]]
+
+    users = await db.users.find(
+        {"user_id": {"$in": friend_ids}},
+        USER_PROJECTION
+    ).to_list(None)
+    by_id = {u["user_id"]: u for u in users}
+    return {
+        "items": [by_id[fid] for fid in friend_ids if fid in by_id],
+        "next_cursor": encode_cursor({"friend_id": friend_ids[-1]}) if has_more else None
+    }
+
+# Imports, geocoding and friends' profile changes move markers in the background: always revalidate
+@app.get("/api/friends/map", dependencies=[Depends(conditional_get("map", cache_control="private, no-cache"))])
+async def get_friends_for_map(request: Request, user: dict = Depends(get_current_user), bbox: Optional[str] = None):
+    """Get friends with location data for map, optionally only inside a bbox viewport"""
+    if bbox:
+        viewport = parse_bbox(bbox)
+        friends = await load_friend_users(user["user_id"], viewport)
+    else:
+        viewport = None
+        friends, _ = snapshot_sources(await get_map_snapshot(user["user_id"]))
+    map_data = []
+    for friend in friends:
+        marker = active_friend_marker(friend)
+        if marker:
+            map_data.append(marker)
+        map_data.extend(competent_friend_markers(friend))
+    if viewport:
+        map_data = [m for m in map_data if point_in_bbox(m["lat"], m["lng"], viewport)]
+    return map_response(request, map_data)
+
 @app.post("/api/friends/request")
 async def send_friend_request(req: FriendRequest, user: dict = Depends(get_current_user)):
     """Send friend request"""
     if req.to_user_id == user["user_id"]:
         raise HTTPException(status_code=400, detail="Cannot friend yourself")
     
-    target = await db.users.find_one({"user_id": req.to_user_id}, {"_id": 0})
+    target = await get_user_doc(req.to_user_id)
     if not target:
         raise HTTPException(status_code=404, detail="User not found")
     
-    existing = await db.friendships.find_one({
-        "$or": [
-            {"user_id": user["user_id"], "friend_id": req.to_user_id},
-            {"user_id": req.to_user_id, "friend_id": user["user_id"]}
-        ]
-    }, {"_id": 0})
-    
-    if existing:
+    friendship_id = f"friendship_{uuid.uuid4().hex[:12]}"
+    try:
+        # The unique pair_key index rejects a second request in either direction
+        await db.friendships.insert_one({
+            "friendship_id": friendship_id,
+            "pair_key": friendship_pair_key(user["user_id"], req.to_user_id),
+            "user_ids": sorted((user["user_id"], req.to_user_id)),
+            "user_id": user["user_id"],
+            "friend_id": req.to_user_id,
+            "status": "pending",
+            "created_at": datetime.now(timezone.utc)
+        })
+    except DuplicateKeyError:
         raise HTTPException(status_code=400, detail="Friendship already exists")
     
-    friendship_id = f"friendship_{uuid.uuid4().hex[:12]}"
-    await db.friendships.insert_one({
+    await publish_event([req.to_user_id], "friend_request", {
         "friendship_id": friendship_id,
-        "user_id": user["user_id"],
-        "friend_id": req.to_user_id,
-        "status": "pending",
-        "created_at": datetime.now(timezone.utc)
+        "from_user": {k: user.get(k) for k in PROFILE_SUMMARY_FIELDS}
     })
-    
     return {"message": "Friend request sent", "friendship_id": friendship_id}
 
 @app.get("/api/friends/requests")
-async def get_friend_requests(user: dict = Depends(get_current_user)):
+async def get_friend_requests(user: dict = Depends(get_current_user), loader: UserLoader = Depends(get_user_loader)):
     """Get pending friend requests"""
     requests = await db.friendships.find(
         {"friend_id": user["user_id"], "status": "pending"},
         {"_id": 0}
     ).to_list(100)
+    senders = await loader.load_many(req["user_id"] for req in requests)
     
     result = []
     for req in requests:
-        sender = await db.users.find_one({"user_id": req["user_id"]}, {"_id": 0})
+        sender = senders.get(req["user_id"])
         if sender:
             result.append({
                 "friendship_id": req["friendship_id"],
@@ -341,144 +1417,1441 @@ async def get_friend_requests(user: dict = Depends(get_current_user)):
 @app.post("/api/friends/accept/{friendship_id}")
 async def accept_friend_request(friendship_id: str, user: dict = Depends(get_current_user)):
     """Accept friend request"""
-    result = await db.friendships.update_one(
-        {"friendship_id": friendship_id, "friend_id": user["user_id"], "status": "pending"},
-        {"$set": {"status": "accepted", "accepted_at": datetime.now(timezone.utc)}}
-    )
-    if result.modified_count == 0:
+    async def accept(session):
+        friendship = await db.friendships.find_one_and_update(
+            {"friendship_id": friendship_id, "friend_id": user["user_id"], "status": "pending"},
+            {"$set": {"status": "accepted", "accepted_at": datetime.now(timezone.utc)}},
+            session=session
+        )
+        if friendship:
+            await add_friend_edges(friendship["user_id"], friendship["friend_id"], session)
+        return friendship
+
+    friendship = await run_transaction(accept)
+    if not friendship:
         raise HTTPException(status_code=404, detail="Friend request not found")
+
+    requester = await get_user_doc(friendship["user_id"])
+    if requester:
+        await patch_map_snapshots([user["user_id"]], f"u:{requester['user_id']}", friend_snapshot_entry(requester))
+    await patch_map_snapshots([friendship["user_id"]], f"u:{user['user_id']}", friend_snapshot_entry(user))
+    await publish_event([friendship["user_id"]], "friend_request_accepted", {
+        "friendship_id": friendship_id,
+        "user": {k: user.get(k) for k in PROFILE_SUMMARY_FIELDS}
+    })
     return {"message": "Friend request accepted"}
 
 @app.delete("/api/friends/{friend_id}")
 async def remove_friend(friend_id: str, user: dict = Depends(get_current_user)):
     """Remove friend"""
-    await db.friendships.delete_one({
-        "$or": [
-            {"user_id": user["user_id"], "friend_id": friend_id},
-            {"user_id": friend_id, "friend_id": user["user_id"]}
-        ]
-    })
+    async def remove(session):
+        await db.friendships.delete_one(
+            {"pair_key": friendship_pair_key(user["user_id"], friend_id)},
+            session=session
+        )
+        await remove_friend_edges(user["user_id"], friend_id, session)
+
+    await run_transaction(remove)
+    await patch_map_snapshots([user["user_id"]], f"u:{friend_id}", None)
+    await patch_map_snapshots([friend_id], f"u:{user['user_id']}", None)
     return {"message": "Friend removed"}
 
+# ============== OFFLINE GAZETTEER ==============
+#
+# Index file layout: b"GAZ1", a little-endian uint32 header length, a JSON header
+# mapping each section to [offset, length, typecode], then 4-byte aligned arrays:
+#   places:   lat/lng (float32), population (uint32), country (2 bytes each),
+#             name_offsets (uint32, N+1) into the names blob
+#   keys:     normalized alias keys sorted bytewise (key_offsets into the keys
+#             blob, N+1) and the place of each key (key_places)
+#   trigrams: sorted crc32 of each trigram, postings_offsets (N+1) into postings,
+#             which lists key indices
+# Every section is read straight from the mmap through memoryview casts.
+
+def gazetteer_key(text: str) -> str:
+    return " ".join(search_tokens(text))
+
+
+def key_trigrams(key: str) -> set:
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def trigram_hash(trigram: str) -> int:
+    return zlib.crc32(trigram.encode())
+
+
+def read_geonames(source: str):
+    """Yield the tab-separated rows of a GeoNames cities dump, zipped or not"""
+    if source.endswith(".zip"):
+        with zipfile.ZipFile(source) as archive:
+            member = next(name for name in archive.namelist() if name.endswith(".txt"))
+            with archive.open(member) as f:
+                for line in io.TextIOWrapper(f, encoding="utf-8"):
+                    yield line.rstrip("\n").split("\t")
+    else:
+        with open(source, encoding="utf-8") as f:
+            for line in f:
+                yield line.rstrip("\n").split("\t")
+
+
+class Gazetteer:
+    """Memory-mapped offline city index with exact and trigram lookups"""
+
+    MAGIC = b"GAZ1"
+
+    def __init__(self, index_path: str):
+        self._file = open(index_path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:4] != self.MAGIC:
+            self.close()
+            raise ValueError(f"{index_path} is not a gazetteer index")
+        header_len = int.from_bytes(self._mm[4:8], "little")
+        self.header = json.loads(self._mm[8:8 + header_len])
+        view = memoryview(self._mm)
+        self._views = []
+        for name, (offset, length, typecode) in self.header["sections"].items():
+            section = view[offset:offset + length]
+            if typecode != "B":
+                section = section.cast(typecode)
+            self._views.append(section)
+            setattr(self, name, section)
+        self._views.append(view)
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def open(cls, source: str, index_path: str, min_population: int = 0) -> "Gazetteer":
+        """Open the compiled index, (re)building it when the dump changed"""
+        stat = os.stat(source)
+        stamp = {"source_size": stat.st_size, "source_mtime": stat.st_mtime, "min_population": min_population}
+        try:
+            gazetteer = cls(index_path)
+            if all(gazetteer.header.get(k) == v for k, v in stamp.items()) and gazetteer.header.get("byteorder") == sys.byteorder:
+                return gazetteer
+            gazetteer.close()
+        except (OSError, ValueError, KeyError):
+            pass
+        cls.compile(source, index_path, stamp)
+        return cls(index_path)
+
+    @classmethod
+    def compile(cls, source: str, index_path: str, stamp: dict):
+        lats, lngs, populations = array("f"), array("f"), array("I")
+        countries = bytearray()
+        names = bytearray()
+        name_offsets = array("I", [0])
+        keys = set()
+        for cols in read_geonames(source):
+            if len(cols) < 15:
+                continue
+            try:
+                lat, lng, population = float(cols[4]), float(cols[5]), int(cols[14] or 0)
+            except ValueError:
+                continue
+            if population < stamp["min_population"]:
+                continue
+            place = len(lats)
+            lats.append(lat)
+            lngs.append(lng)
+            populations.append(min(population, 0xFFFFFFFF))
+            countries += (cols[8] or "  ")[:2].ljust(2).encode("ascii", "replace")
+            names += cols[1].encode()
+            name_offsets.append(len(names))
+            # Alternate names carry the Italian/English/local variants ("Milan", "Mailand")
+            for alias in {cols[1], cols[2], *cols[3].split(",")}:
+                key = gazetteer_key(alias)
+                if key and key.isascii():
+                    keys.add((key.encode(), place))
+
+        sorted_keys = sorted(keys)
+        key_blob = bytearray()
+        key_offsets = array("I", [0])
+        key_places = array("I")
+        postings_by_trigram: Dict[int, List[int]] = {}
+        for index, (key, place) in enumerate(sorted_keys):
+            key_blob += key
+            key_offsets.append(len(key_blob))
+            key_places.append(place)
+            for trigram in key_trigrams(key.decode()):
+                postings_by_trigram.setdefault(trigram_hash(trigram), []).append(index)
+        trigram_hashes = array("I", sorted(postings_by_trigram))
+        postings = array("I")
+        postings_offsets = array("I", [0])
+        for h in trigram_hashes:
+            postings.extend(postings_by_trigram[h])
+            postings_offsets.append(len(postings))
+
+        sections = [
+            ("lats", lats, "f"), ("lngs", lngs, "f"), ("populations", populations, "I"),
+            ("countries", countries, "B"), ("names", names, "B"), ("name_offsets", name_offsets, "I"),
+            ("keys", key_blob, "B"), ("key_offsets", key_offsets, "I"), ("key_places", key_places, "I"),
+            ("trigrams", trigram_hashes, "I"), ("postings_offsets", postings_offsets, "I"), ("postings", postings, "I"),
+        ]
+        blobs = [bytes(data) for _, data, _ in sections]
+        # Offsets depend on the header length, which depends on the offsets: fix the point
+        header_len = 0
+        while True:
+            offset = 8 + header_len
+            layout = {}
+            for (name, _, typecode), blob in zip(sections, blobs):
+                offset += -offset % 4
+                layout[name] = [offset, len(blob), typecode]
+                offset += len(blob)
+            header = json.dumps({**stamp, "byteorder": sys.byteorder, "places": len(lats),
+                                 "keys": len(sorted_keys), "sections": layout}).encode()
+            if len(header) == header_len:
+                break
+            header_len = len(header)
+
+        tmp_path = f"{index_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(cls.MAGIC + len(header).to_bytes(4, "little") + header)
+            for name, blob in zip(layout, blobs):
+                f.write(b"\0" * (layout[name][0] - f.tell()))
+                f.write(blob)
+        os.replace(tmp_path, index_path)
+        print(f"Compiled gazetteer: {len(lats)} places, {len(sorted_keys)} keys")
+
+    def close(self):
+        for view in getattr(self, "_views", []):
+            view.release()
+        self._mm.close()
+        self._file.close()
+
+    def _key(self, index: int) -> bytes:
+        return bytes(self.keys[self.key_offsets[index]:self.key_offsets[index + 1]])
+
+    def _place(self, place: int) -> dict:
+        country = bytes(self.countries[2 * place:2 * place + 2]).decode().strip()
+        name = bytes(self.names[self.name_offsets[place]:self.name_offsets[place + 1]]).decode()
+        return {
+            "lat": round(self.lats[place], 5),
+            "lng": round(self.lngs[place], 5),
+            "display_name": f"{name}, {country}" if country else name,
+            "country_code": country.lower() or None,
+            "status": "success"
+        }
+
+    def _exact(self, key: bytes) -> List[int]:
+        lo, hi = 0, len(self.key_places)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        places = []
+        while lo < len(self.key_places) and self._key(lo) == key:
+            places.append(self.key_places[lo])
+            lo += 1
+        return places
+
+    def _fuzzy(self, key: str) -> List[Tuple[float, int]]:
+        query_trigrams = key_trigrams(key)
+        shared: Dict[int, int] = {}
+        skipped = 0
+        for trigram in query_trigrams:
+            h = trigram_hash(trigram)
+            i = bisect_left(self.trigrams, h)
+            if i < len(self.trigrams) and self.trigrams[i] == h:
+                start, end = self.postings_offsets[i], self.postings_offsets[i + 1]
+                # Very common trigrams barely discriminate and dominate the scan
+                if end - start > GAZETTEER_MAX_POSTINGS:
+                    skipped += 1
+                    continue
+                for index in self.postings[start:end]:
+                    shared[index] = shared.get(index, 0) + 1
+        # Jaccard similarity on trigram sets, only for keys sharing enough trigrams to qualify
+        needed = GAZETTEER_MIN_SIMILARITY * len(query_trigrams) - skipped
+        matches = []
+        for index, count in shared.items():
+            if count < needed:
+                continue
+            candidate = key_trigrams(self._key(index).decode())
+            common = len(query_trigrams & candidate)
+            similarity = common / (len(query_trigrams) + len(candidate) - common)
+            if similarity >= GAZETTEER_MIN_SIMILARITY:
+                matches.append((similarity, self.key_places[index]))
+        return matches
+
+    def lookup(self, query: str, fuzzy: bool = False) -> Optional[dict]:
+        """Best place for `query`: exact name matches by population, then (with fuzzy)
+        trigram matches by similarity and population; None if unsure"""
+        city, _, suffix = query.partition(",")
+        country = None
+        if suffix.strip():
+            # "City, XX" narrows to an ISO country; other qualifiers need the full geocoder
+            country = suffix.strip().upper()
+            if len(country) != 2 or not country.isalpha():
+                return None
+        key = gazetteer_key(city)
+        if not key:
+            return None
+
+        def in_country(place):
+            return country is None or bytes(self.countries[2 * place:2 * place + 2]).decode() == country
+
+        places = [p for p in self._exact(key.encode()) if in_country(p)]
+        if places:
+            best = max(places, key=lambda p: self.populations[p])
+        else:
+            matches = [(sim, p) for sim, p in self._fuzzy(key) if in_country(p)] if fuzzy and len(key) >= 4 else []
+            if not matches:
+                self.misses += 1
+                return None
+            # Population breaks near-ties: a 10M city outweighs a ~0.1 similarity gap
+            best = max(matches, key=lambda m: m[0] + 0.015 * math.log10(1 + self.populations[m[1]]))[1]
+        self.hits += 1
+        return self._place(best)
+
+    def stats(self) -> dict:
+        return {"places": self.header["places"], "keys": self.header["keys"], "hits": self.hits, "misses": self.misses}
+
+
+# Loaded at startup when GAZETTEER_PATH is set
+gazetteer: Optional[Gazetteer] = None
+
+
+async def load_gazetteer():
+    global gazetteer
+    if not GAZETTEER_PATH:
+        return
+    try:
+        gazetteer = await asyncio.to_thread(
+            Gazetteer.open, GAZETTEER_PATH, f"{GAZETTEER_PATH}.idx", GAZETTEER_MIN_POPULATION
+        )
+    except Exception as e:
+        print(f"WARNING: could not load gazetteer from {GAZETTEER_PATH}: {e}")
+
 # ============== GEOCODING HELPER ==============
+#
+# Lookups try an exact gazetteer name, then the in-process LRU, the shared
+# geocode_cache collection (TTL-indexed on expires_at), and only then Nominatim.
+# Empty answers are cached too, for a shorter time; transport errors are not
+# cached. Only when all of these come back empty is a fuzzy gazetteer match used.
+
+class LocalTokenBucket:
+    """In-process token bucket: `rate` tokens per second, holding at most `burst`"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    async def try_acquire(self) -> float:
+        """Take a token and return 0, or return the seconds until one is available"""
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+
+class MongoTokenBucket:
+    """Token bucket kept in one document, refilled and debited by a single pipeline update"""
+
+    # Server errors meaning pipeline updates or $$NOW aren't supported (MongoDB < 4.2):
+    # FailedToParse, TypeMismatch, undefined variable, unrecognized stage
+    UNSUPPORTED_CODES = {9, 14, 17276, 40324}
+
+    def __init__(self, name: str, rate: float, burst: float):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        # Used when the server can't run pipeline updates (MongoDB < 4.2)
+        self._fallback: Optional[LocalTokenBucket] = None
+
+    async def try_acquire(self) -> float:
+        if self._fallback is not None:
+            return await self._fallback.try_acquire()
+        # Refill from the server clock ($$NOW) so workers with skewed clocks agree
+        refilled = {"$min": [self.burst, {"$add": [
+            {"$ifNull": ["$tokens", self.burst]},
+            {"$multiply": [
+                {"$subtract": ["$$NOW", {"$ifNull": ["$updated_at", "$$NOW"]}]},
+                self.rate / 1000
+            ]}
+        ]}]}
+        pipeline = [
+            {"$set": {"tokens": refilled, "updated_at": "$$NOW"}},
+            {"$set": {
+                "granted": {"$gte": ["$tokens", 1]},
+                "tokens": {"$cond": [{"$gte": ["$tokens", 1]}, {"$subtract": ["$tokens", 1]}, "$tokens"]}
+            }}
+        ]
+        try:
+            try:
+                bucket = await db.rate_limits.find_one_and_update(
+                    {"_id": self.name}, pipeline, upsert=True, return_document=ReturnDocument.AFTER
+                )
+            except DuplicateKeyError:
+                # Another worker created the document first
+                bucket = await db.rate_limits.find_one_and_update(
+                    {"_id": self.name}, pipeline, return_document=ReturnDocument.AFTER
+                )
+        except OperationFailure as e:
+            if e.code not in self.UNSUPPORTED_CODES:
+                return self._backoff(e)
+            print(f"WARNING: shared rate limiter unsupported by the server, limiting per process: {e}")
+            self._fallback = LocalTokenBucket(self.rate, self.burst)
+            return await self._fallback.try_acquire()
+        except Exception as e:
+            return self._backoff(e)
+        if bucket["granted"]:
+            return 0
+        return (1 - bucket["tokens"]) / self.rate
+
+    def _backoff(self, error: Exception) -> float:
+        """Transient failure: grant nothing and retry the shared bucket after one refill interval"""
+        print(f"WARNING: shared rate limiter unavailable, retrying: {error}")
+        return max(1 / self.rate, 1.0)
+
+
+class GeocodeScheduler:
+    """Hands out upstream call slots from a token bucket, draining the interactive lane before bulk"""
+
+    LANES = ("interactive", "bulk")
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.granted = {lane: 0 for lane in self.LANES}
+        self._waiters = {lane: deque() for lane in self.LANES}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def acquire(self, lane: str = "interactive"):
+        if self._task is None or self._task.done():
+            # Created here, inside the running loop (Python 3.9 binds Events at construction)
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._dispatch())
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[lane].append(waiter)
+        self._wakeup.set()
+        await waiter
+
+    def _next_waiter(self) -> Optional[Tuple[str, asyncio.Future]]:
+        for lane in self.LANES:
+            queue = self._waiters[lane]
+            while queue and queue[0].done():  # cancelled callers
+                queue.popleft()
+            if queue:
+                return lane, queue[0]
+        return None
+
+    async def _dispatch(self):
+        while True:
+            if self._next_waiter() is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            wait = await self.bucket.try_acquire()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            # Re-pick after the await: an interactive caller may have arrived meanwhile
+            picked = self._next_waiter()
+            if picked:
+                lane, waiter = picked
+                self._waiters[lane].popleft()
+                waiter.set_result(None)
+                self.granted[lane] += 1
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "queued": {lane: sum(1 for w in self._waiters[lane] if not w.done()) for lane in self.LANES},
+            "granted": dict(self.granted)
+        }
+
 
-async def geocode_city(city_name: str) -> dict:
-    """Geocode a city name using OpenStreetMap Nominatim API"""
+geocode_scheduler = GeocodeScheduler(
+    MongoTokenBucket("nominatim", GEOCODE_RATE, GEOCODE_BURST) if GEOCODE_RATE_LIMITER == "mongo"
+    else LocalTokenBucket(GEOCODE_RATE, GEOCODE_BURST)
+)
+
+# normalized query -> {"lat", "lng", "display_name", "country_code", "status"}
+geocode_memory_cache = TTLCache(GEOCODE_MEMORY_CACHE_SIZE)
+# Concurrent lookups of one normalized query share a single cache read / upstream call
+geocode_flights = SingleFlight()
+
+
+def geocode_cache_key(city_name: str) -> str:
+    """Normalized lookup key, so that "  Milano ,Italia" and "milano, italia" share an entry"""
+    parts = [" ".join(part.split()) for part in normalize_search_text(city_name).split(",")]
+    return ", ".join(part for part in parts if part)
+
+
+def failed_geocode(city_name: str) -> dict:
+    return {"lat": None, "lng": None, "display_name": city_name, "status": "failed"}
+
+
+async def fetch_nominatim(city_name: str, lane: str = "interactive") -> Optional[dict]:
+    """Query Nominatim; None on transport errors, a "failed" result when nothing matched"""
+    await geocode_scheduler.acquire(lane)
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                "https://nominatim.openstreetmap.org/search",
-                params={
-                    "q": city_name,
-                    "format": "json",
-                    "limit": 1,
-                    "addressdetails": 1
-                },
-                headers={"User-Agent": "MapYourFriends/1.0"}
-            )
-            if response.status_code == 200:
-                results = response.json()
-                if results:
-                    result = results[0]
-                    return {
-                        "lat": float(result["lat"]),
-                        "lng": float(result["lon"]),
-                        "display_name": result.get("display_name", city_name),
-                        "status": "success"
-                    }
-            return {"lat": None, "lng": None, "display_name": city_name, "status": "failed"}
+        response = await get_http_client().get(
+            "https://nominatim.openstreetmap.org/search",
+            params={
+                "q": city_name,
+                "format": "json",
+                "limit": 1,
+                "addressdetails": 1
+            }
+        )
     except Exception as e:
         print(f"Geocoding error: {e}")
-        return {"lat": None, "lng": None, "display_name": city_name, "status": "failed"}
+        return None
+    if response.status_code != 200:
+        print(f"Geocoding error: HTTP {response.status_code}")
+        return None
+    results = response.json()
+    if not results:
+        return failed_geocode(city_name)
+    result = results[0]
+    return {
+        "lat": float(result["lat"]),
+        "lng": float(result["lon"]),
+        "display_name": result.get("display_name", city_name),
+        "country_code": (result.get("address") or {}).get("country_code"),
+        "status": "success"
+    }
+
+
+async def lookup_geocode(key: str, city_name: str, lane: str) -> Optional[dict]:
+    """Shared cache, then Nominatim; fills both cache layers. None on transport errors"""
+    cached = await db.geocode_cache.find_one(
+        {"_id": key, "expires_at": {"$gt": datetime.now(timezone.utc)}}
+    )
+    if cached:
+        result = cached["result"]
+        geocode_memory_cache.set(key, result, expires_at=as_utc(cached["expires_at"]).timestamp())
+        return result
+
+    result = await fetch_nominatim(city_name, lane)
+    if result is None:
+        return None
+    ttl = GEOCODE_CACHE_TTL if result["status"] == "success" else GEOCODE_NEGATIVE_TTL
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=ttl)
+    await db.geocode_cache.update_one(
+        {"_id": key},
+        {"$set": {"query": city_name, "result": result, "expires_at": expires_at}},
+        upsert=True
+    )
+    geocode_memory_cache.set(key, result, expires_at=expires_at.timestamp())
+    return result
+
+
+async def geocode_city(city_name: str, lane: str = "interactive") -> dict:
+    """Geocode a city name using OpenStreetMap Nominatim API (imports use the "bulk" lane)"""
+    key = geocode_cache_key(city_name or "")
+    if not key:
+        return failed_geocode(city_name)
+
+    # An exact gazetteer name is a binary search: cheap enough for the event loop
+    if gazetteer is not None:
+        local = gazetteer.lookup(key)
+        if local:
+            return local
+
+    result = geocode_memory_cache.get(key)
+    if result is None:
+        result = await geocode_flights.do(key, lambda: lookup_geocode(key, city_name, lane))
+
+    if result is None or result["status"] != "success":
+        # Last resort: a close spelling from the gazetteer ("Milanoo"); the trigram scan runs off the loop
+        if gazetteer is not None:
+            local = await asyncio.to_thread(gazetteer.lookup, key, True)
+            if local:
+                return local
+        return failed_geocode(city_name)
+    return dict(result)
 
 # ============== IMPORTED FRIENDS ENDPOINTS ==============
 
-@app.post("/api/imported-friends/csv")
+async def find_located_imported_friends(owner_id: str, bbox: Optional[Tuple[float, float, float, float]] = None) -> List[dict]:
+    """Geocoded imported friends of `owner_id`, optionally only those inside `bbox`"""
+    query = {"owner_id": owner_id, "city_lat": {"$ne": None}}
+    geo_filter = bbox_geo_filter(bbox) if bbox else None
+    if geo_filter:
+        query = {"owner_id": owner_id, "location": geo_filter}
+    friends = await db.imported_friends.find(query, IMPORTED_PROJECTION).to_list(None)
+    if bbox:
+        friends = [f for f in friends if point_in_bbox(f["city_lat"], f["city_lng"], bbox)]
+    return friends
+
+
+# ============== DUPLICATES ==============
+#
+# Every imported friend stores a fingerprint of its normalized name, email, phone
+# and city (exact duplicates, checked with one $in query per import chunk) and a
+# few blocking keys: surname + first initial in both name orders, email, phone.
+# Near-duplicates ("Giovanni Rossi" / "G. Rossi, Milan") are only compared within
+# a shared block, never pairwise across the whole list.
+
+def friend_name_tokens(fields: dict) -> List[str]:
+    return search_tokens(f"{fields.get('first_name') or ''} {fields.get('last_name') or ''}")
+
+
+def phone_key(phone: Optional[str]) -> str:
+    return re.sub(r"\D", "", phone or "")[-DEDUP_PHONE_DIGITS:]
+
+
+def email_key(email: Optional[str]) -> str:
+    return (email or "").strip().lower()
+
+
+def friend_dedup_fields(fields: dict) -> dict:
+    """fingerprint and block_keys of an imported friend"""
+    tokens = friend_name_tokens(fields)
+    email, phone = email_key(fields.get("email")), phone_key(fields.get("phone"))
+    fingerprint = hashlib.sha1("\x1f".join([
+        " ".join(tokens), email, phone, geocode_cache_key(fields.get("city") or "")
+    ]).encode()).hexdigest()
+    block_keys = set()
+    if len(tokens) > 1:
+        first, last = tokens[0], tokens[-1]
+        # Both orders, for files with swapped name columns; a bare initial is no surname
+        for surname, given in ((last, first), (first, last)):
+            if len(surname) > 1:
+                block_keys.add(f"n:{surname}:{given[0]}")
+    if email:
+        block_keys.add(f"e:{email}")
+    if phone:
+        block_keys.add(f"p:{phone}")
+    return {"fingerprint": fingerprint, "block_keys": sorted(block_keys)}
+
+
+def same_city(a: dict, b: dict) -> bool:
+    key_a, key_b = geocode_cache_key(a.get("city") or ""), geocode_cache_key(b.get("city") or "")
+    if not key_a or not key_b or key_a.startswith(key_b) or key_b.startswith(key_a):
+        return True
+    if None in (a.get("city_lat"), a.get("city_lng"), b.get("city_lat"), b.get("city_lng")):
+        return False
+    return (abs(a["city_lat"] - b["city_lat"]) <= DEDUP_CITY_DEGREES
+            and abs(a["city_lng"] - b["city_lng"]) <= DEDUP_CITY_DEGREES)
+
+
+def likely_duplicates(a: dict, b: dict) -> bool:
+    """Whether two imported friends sharing a block are the same person"""
+    if a["fingerprint"] == b["fingerprint"]:
+        return True
+    if email_key(a.get("email")) and email_key(a.get("email")) == email_key(b.get("email")):
+        return True
+    if phone_key(a.get("phone")) and phone_key(a.get("phone")) == phone_key(b.get("phone")):
+        return True
+    tokens_a, tokens_b = friend_name_tokens(a), friend_name_tokens(b)
+    if len(tokens_a) < 2 or len(tokens_b) < 2 or not same_city(a, b):
+        return False
+    # Same surname and compatible first names ("g" / "giovanni"), in either order
+    for first_b, last_b in ((tokens_b[0], tokens_b[-1]), (tokens_b[-1], tokens_b[0])):
+        if tokens_a[-1] == last_b and (tokens_a[0].startswith(first_b) or first_b.startswith(tokens_a[0])):
+            return True
+    return False
+
+
+async def find_duplicate_groups(owner_id: str) -> List[List[dict]]:
+    """Groups of imported friends of an owner that look like the same person"""
+    blocks = await db.imported_friends.aggregate([
+        {"$match": {"owner_id": owner_id}},
+        {"$unwind": "$block_keys"},
+        {"$group": {"_id": "$block_keys", "friend_ids": {"$push": "$friend_id"}}},
+        {"$match": {"friend_ids.1": {"$exists": True}}}
+    ]).to_list(None)
+    exact = await db.imported_friends.aggregate([
+        {"$match": {"owner_id": owner_id}},
+        {"$group": {"_id": "$fingerprint", "friend_ids": {"$push": "$friend_id"}}},
+        {"$match": {"friend_ids.1": {"$exists": True}}}
+    ]).to_list(None)
+    candidate_ids = {friend_id for block in blocks + exact for friend_id in block["friend_ids"]}
+    if not candidate_ids:
+        return []
+    friends = {
+        friend["friend_id"]: friend
+        for friend in await db.imported_friends.find(
+            {"owner_id": owner_id, "friend_id": {"$in": list(candidate_ids)}},
+            {"_id": 0, "location": 0, "block_keys": 0}
+        ).to_list(None)
+    }
+
+    # Union-find over the confirmed pairs of each block
+    parent = {friend_id: friend_id for friend_id in friends}
+
+    def root(friend_id: str) -> str:
+        while parent[friend_id] != friend_id:
+            parent[friend_id] = parent[parent[friend_id]]
+            friend_id = parent[friend_id]
+        return friend_id
+
+    for block in blocks + exact:
+        ids = [friend_id for friend_id in block["friend_ids"] if friend_id in friends]
+        for i, a in enumerate(ids):
+            for b in ids[i + 1:]:
+                if root(a) != root(b) and likely_duplicates(friends[a], friends[b]):
+                    parent[root(b)] = root(a)
+
+    groups: Dict[str, List[dict]] = {}
+    for friend_id, friend in friends.items():
+        groups.setdefault(root(friend_id), []).append(friend)
+    return [
+        sorted(group, key=lambda friend: (as_utc(friend["created_at"]), friend["friend_id"]))
+        for group in groups.values() if len(group) > 1
+    ]
+
+
+# ============== IMPORT PARSING ==============
+#
+# Uploads are consumed as a pipeline of async generators (bytes -> text -> lines ->
+# rows) so only one chunk and the record being assembled are held in memory.
+# Rows come out as (row, error) pairs: a record that can't be parsed becomes a
+# failed job row carrying its raw text instead of being dropped. The
+# UploadFile itself is spooled to disk by Starlette past 1 MB, and ZIP members are
+# streamed out of it without extracting.
+
+IMPORT_FILE_TYPES = {".csv": "csv", ".vcf": "vcard", ".vcard": "vcard", ".zip": "zip"}
+
+
+def detect_encoding(sample: bytes) -> str:
+    """Text encoding of an upload from its first bytes: BOM, else UTF-8 if valid, else cp1252/latin-1"""
+    if sample.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return "utf-16"
+    try:
+        # Not final: the sample may end inside a multi-byte character
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+    try:
+        sample.decode("cp1252")
+        return "cp1252"
+    except UnicodeDecodeError:
+        return "latin-1"
+
+
+async def upload_chunks(file: UploadFile) -> AsyncIterator[bytes]:
+    while True:
+        chunk = await file.read(IMPORT_READ_CHUNK)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def zip_member_chunks(archive: zipfile.ZipFile, name: str) -> AsyncIterator[bytes]:
+    with archive.open(name) as member:
+        while True:
+            chunk = await asyncio.to_thread(member.read, IMPORT_READ_CHUNK)
+            if not chunk:
+                return
+            yield chunk
+
+
+async def decode_chunks(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Incrementally decode a byte stream, detecting the encoding from its first bytes"""
+    sample = b""
+    async for chunk in chunks:
+        sample += chunk
+        if len(sample) >= IMPORT_ENCODING_SAMPLE:
+            break
+    decoder = codecs.getincrementaldecoder(detect_encoding(sample))(errors="replace")
+    yield decoder.decode(sample)
+    async for chunk in chunks:
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
+
+
+async def text_lines(texts: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Lines of a text stream, line endings stripped"""
+    pending = ""
+    async for text in texts:
+        pending += text
+        lines = pending.split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line.rstrip("\r")
+    if pending:
+        yield pending.rstrip("\r")
+
+
+def csv_record_open(record: str) -> bool:
+    """Whether `record` ends inside a quoted field, by the csv module's default dialect:
+    only a quote opening a field starts quoting, so O"Brien is plain text"""
+    if '"' not in record:
+        return False
+    in_quotes = quote_seen = False
+    field_start = True
+    for char in record:
+        if in_quotes:
+            if quote_seen:
+                quote_seen = False
+                if char == '"':  # "" is an escaped quote
+                    continue
+                in_quotes = False
+            elif char == '"':
+                quote_seen = True
+                continue
+            else:
+                continue
+        if char == '"' and field_start:
+            in_quotes = True
+            field_start = False
+        else:
+            field_start = char in ",\n"
+    return in_quotes and not quote_seen
+
+
+async def csv_rows(lines: AsyncIterator[str], header_column: Optional[str] = None) -> AsyncIterator[Tuple[dict, Optional[str]]]:
+    """CSV rows keyed by header, assembled across lines while a quoted field is open.
+
+    A record still open after IMPORT_MAX_RECORD_LINES lines, or at the end of the
+    file, yields its first line as a failed row and the following lines are read
+    again. With header_column, records before the first one containing that
+    column are skipped (export preambles such as LinkedIn's notes)."""
+    header = None
+    pending: List[str] = []
+
+    def parse(record: str) -> Optional[Tuple[dict, Optional[str]]]:
+        nonlocal header
+        values = next(csv.reader([record]), [])
+        if not any(value.strip() for value in values):
+            return None
+        if header is None:
+            if header_column is None or header_column in values:
+                header = [value.strip() for value in values]
+            return None
+        return {name: values[i] if i < len(values) else None for i, name in enumerate(header)}, None
+
+    def drain(at_end: bool) -> List[Tuple[dict, Optional[str]]]:
+        out = []
+        while pending:
+            # Shortest run of pending lines forming a complete record
+            record = None
+            for end in range(1, len(pending) + 1):
+                candidate = "\n".join(pending[:end])
+                if not csv_record_open(candidate):
+                    record = candidate
+                    del pending[:end]
+                    break
+            if record is None:
+                if not at_end and len(pending) < IMPORT_MAX_RECORD_LINES:
+                    break
+                broken = pending.pop(0)
+                if header is not None:
+                    out.append(({"record": broken}, "Unterminated quoted field"))
+                continue
+            row = parse(record)
+            if row:
+                out.append(row)
+        return out
+
+    async for line in lines:
+        pending.append(line)
+        for row in drain(at_end=False):
+            yield row
+    for row in drain(at_end=True):
+        yield row
+
+
+def vcard_values(value: str, separator: str = ";") -> List[str]:
+    """Split a vCard structured value on unescaped separators and unescape its parts"""
+    parts, current, escaped = [], "", False
+    for char in value:
+        if escaped:
+            current += "\n" if char in "nN" else char
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == separator:
+            parts.append(current)
+            current = ""
+        else:
+            current += char
+    parts.append(current)
+    return parts
+
+
+def vcard_row(properties: List[Tuple[str, str]]) -> dict:
+    """Import row of a vCard, using the CSV column names import_row_fields understands"""
+    row = {}
+    for name, value in properties:
+        if name == "N" and "First Name" not in row:
+            parts = vcard_values(value) + ["", ""]
+            row["Last Name"], row["First Name"] = parts[0].strip(), parts[1].strip()
+        elif name == "FN" and "fn" not in row:
+            row["fn"] = vcard_values(value)[0].strip()
+        elif name == "ADR" and "City" not in row:
+            parts = vcard_values(value)
+            if len(parts) > 3 and parts[3].strip():
+                row["City"] = parts[3].strip()
+        elif name == "EMAIL" and "Email" not in row:
+            row["Email"] = vcard_values(value)[0].strip()
+        elif name == "TEL" and "Phone" not in row:
+            row["Phone"] = vcard_values(value)[0].strip()
+    # Cards with only a formatted name: first word as first name, the rest as surname
+    formatted = row.pop("fn", "")
+    if not row.get("First Name") and formatted:
+        first, _, last = formatted.partition(" ")
+        row["First Name"], row["Last Name"] = first, last.strip()
+    return row
+
+
+async def vcard_rows(lines: AsyncIterator[str]) -> AsyncIterator[Tuple[dict, Optional[str]]]:
+    """One import row per BEGIN:VCARD ... END:VCARD block"""
+    properties = None
+    current = None
+    async for line in lines:
+        # Folded lines continue the previous one after a leading space or tab
+        if line[:1] in (" ", "\t") and current is not None:
+            current += line[1:]
+            continue
+        if current is not None and properties is not None:
+            name, _, value = current.partition(":")
+            # Drop the group prefix (item1.EMAIL) and parameters (TEL;TYPE=cell)
+            properties.append((name.split(";")[0].split(".")[-1].upper(), value))
+        current = None
+        keyword = line.strip().upper()
+        if keyword == "BEGIN:VCARD":
+            properties = []
+        elif keyword == "END:VCARD":
+            if properties is not None:
+                yield vcard_row(properties), None
+            properties = None
+        elif properties is not None:
+            current = line
+
+
+async def zip_rows(archive: zipfile.ZipFile) -> AsyncIterator[Tuple[dict, Optional[str]]]:
+    """Rows of the contacts in an export archive: LinkedIn's Connections.csv and any vCard members"""
+    names = [info.filename for info in archive.infolist() if not info.is_dir()]
+    for name in names:
+        basename = name.rsplit("/", 1)[-1].lower()
+        if basename == "connections.csv":
+            rows = csv_rows(text_lines(decode_chunks(zip_member_chunks(archive, name))), header_column="First Name")
+        elif basename.endswith((".vcf", ".vcard")):
+            rows = vcard_rows(text_lines(decode_chunks(zip_member_chunks(archive, name))))
+        else:
+            continue
+        async for row in rows:
+            yield row
+
+
+def import_file_type(filename: Optional[str]) -> Optional[str]:
+    name = (filename or "").lower()
+    for extension, file_type in IMPORT_FILE_TYPES.items():
+        if name.endswith(extension):
+            return file_type
+    return None
+
+
+async def import_rows(file: UploadFile, file_type: str) -> AsyncIterator[Tuple[dict, Optional[str]]]:
+    """Stream the (row, parse error) pairs of an uploaded CSV, vCard or export ZIP"""
+    if file_type == "zip":
+        # ZipFile seeks in the spooled upload; members are decompressed chunk by chunk
+        await file.seek(0)
+        with zipfile.ZipFile(file.file) as archive:
+            async for row in zip_rows(archive):
+                yield row
+        return
+    lines = text_lines(decode_chunks(upload_chunks(file)))
+    rows = vcard_rows(lines) if file_type == "vcard" else csv_rows(lines)
+    async for row in rows:
+        yield row
+
+
+# ============== IMPORT JOBS ==============
+#
+# An upload is parsed into import_job_rows (one document per CSV row, each with a
+# pre-assigned friend_id) plus an import_jobs document, and answered with 202 right
+# away. ImportWorkerPool workers claim queued jobs under a lease that a heartbeat
+# renews while the job runs, however long it waits for bulk geocode slots; a job
+# whose worker died is claimed again once its lease expires and resumes from its
+# pending rows. Re-inserting an already written row is a no-op
+# thanks to the unique friend_id index. Every claim counts as an attempt: after
+# IMPORT_MAX_ATTEMPTS the job ends as `failed` instead of being retried forever.
+# Once a job ends its rows get an expires_at and are dropped by a TTL index.
+#
+# Processing is planned per city: pending rows are grouped by normalized city,
+# each distinct city is geocoded once, and its rows are written with chunked
+# insert_many / update_many.
+
+def import_row_fields(row: dict, require_city: bool = True) -> Optional[dict]:
+    """Friend fields of a CSV row, whatever the column naming; None if required ones are missing
+
+    Contact exports (LinkedIn connections, vCards) often carry no address: with
+    require_city=False their rows are kept with an empty city, left for the user to set."""
+    # Handle different column name variations
+    first_name = row.get('Nome') or row.get('nome') or row.get('First Name') or row.get('first_name') or ''
+    last_name = row.get('Cognome') or row.get('cognome') or row.get('Last Name') or row.get('last_name') or ''
+    city = row.get('Città') or row.get('citta') or row.get('City') or row.get('city') or ''
+    email = row.get('Email') or row.get('email') or row.get('Email Address') or None
+    phone = row.get('Telefono') or row.get('telefono') or row.get('Phone') or row.get('phone') or None
+    if not first_name or (require_city and not city):
+        return None
+    return {
+        "first_name": first_name.strip(),
+        "last_name": last_name.strip() if last_name else "",
+        "city": city.strip(),
+        "email": email.strip() if email else None,
+        "phone": phone.strip() if phone else None
+    }
+
+
+def imported_friend_document(owner_id: str, friend_id: str, fields: dict, geo_result: dict) -> dict:
+    friend_data = {
+        "friend_id": friend_id,
+        "owner_id": owner_id,
+        **fields,
+        "city_lat": geo_result["lat"],
+        "city_lng": geo_result["lng"],
+        "display_name": geo_result["display_name"],
+        "geocode_status": geo_result["status"],
+        "photo": None,
+        **friend_dedup_fields(fields),
+        "created_at": datetime.now(timezone.utc)
+    }
+    location = geo_point(geo_result["lat"], geo_result["lng"])
+    if location:
+        friend_data["location"] = location
+    return friend_data
+
+
+async def import_job_counts(job_id: str) -> dict:
+    counts = {"imported": 0, "duplicate": 0, "failed": 0, "pending": 0}
+    async for row in db.import_job_rows.aggregate([
+        {"$match": {"job_id": job_id}},
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+    ]):
+        counts[row["_id"]] = row["count"]
+    return counts
+
+
+async def plan_import_job(job_id: str) -> List[dict]:
+    """Distinct normalized cities of the job's pending rows, most rows first"""
+    plan: Dict[str, dict] = {}
+    async for group in db.import_job_rows.aggregate([
+        {"$match": {"job_id": job_id, "status": "pending"}},
+        {"$group": {"_id": "$data.city", "rows": {"$sum": 1}}}
+    ]):
+        key = geocode_cache_key(group["_id"])
+        entry = plan.setdefault(key, {"city": group["_id"], "spellings": [], "rows": 0})
+        entry["spellings"].append(group["_id"])
+        entry["rows"] += group["rows"]
+    return sorted(plan.values(), key=lambda entry: -entry["rows"])
+
+
+async def insert_imported_friends(friends: List[dict]):
+    """insert_many that tolerates rows already written by an interrupted run"""
+    try:
+        await db.imported_friends.insert_many(friends, ordered=False)
+    except BulkWriteError as e:
+        if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+            raise
+
+
+async def process_import_job(job: dict, lease: str):
+    """Import the job's pending rows city by city, recording progress; stops if the lease is lost"""
+    job_id, owner_id = job["job_id"], job["owner_id"]
+    for entry in await plan_import_job(job_id):
+        if geocode_cache_key(entry["city"]):
+            # Geocode the city once for all its rows (upstream calls are paced by the shared scheduler)
+            geo_result = await geocode_city(entry["city"], lane="bulk")
+        else:
+            # Contacts exported without an address stay pending until the user sets a city
+            geo_result = {"lat": None, "lng": None, "display_name": "", "status": "pending"}
+        query = {"job_id": job_id, "data.city": {"$in": entry["spellings"]}, "status": "pending"}
+        while True:
+            rows = await db.import_job_rows.find(
+                query,
+                {"_id": 0, "index": 1, "friend_id": 1, "data": 1}
+            ).limit(IMPORT_BATCH_SIZE).to_list(None)
+            if not rows:
+                break
+            friends = [imported_friend_document(owner_id, row["friend_id"], row["data"], geo_result) for row in rows]
+            # One $in query for the chunk; a friend_id of the chunk itself was written by an interrupted run
+            known = {}
+            written = set()
+            async for friend in db.imported_friends.find(
+                {"owner_id": owner_id, "fingerprint": {"$in": list({friend["fingerprint"] for friend in friends})}},
+                {"_id": 0, "friend_id": 1, "fingerprint": 1}
+            ):
+                known.setdefault(friend["fingerprint"], friend["friend_id"])
+                written.add(friend["friend_id"])
+            new_friends, imported_indexes, duplicates = [], [], []
+            for row, friend in zip(rows, friends):
+                if friend["friend_id"] in written:
+                    imported_indexes.append(row["index"])
+                elif friend["fingerprint"] in known:
+                    duplicates.append(UpdateOne(
+                        {"job_id": job_id, "index": row["index"]},
+                        {"$set": {"status": "duplicate", "duplicate_of": known[friend["fingerprint"]]}}
+                    ))
+                else:
+                    known[friend["fingerprint"]] = friend["friend_id"]
+                    new_friends.append(friend)
+                    imported_indexes.append(row["index"])
+            if new_friends:
+                await insert_imported_friends(new_friends)
+            if imported_indexes:
+                await db.import_job_rows.update_many(
+                    {"job_id": job_id, "index": {"$in": imported_indexes}},
+                    {"$set": {"status": "imported", "lat": geo_result["lat"], "lng": geo_result["lng"],
+                              "geocode_status": geo_result["status"]}}
+                )
+            if duplicates:
+                await db.import_job_rows.bulk_write(duplicates, ordered=False)
+
+        counts = await import_job_counts(job_id)
+        now = datetime.now(timezone.utc)
+        renewed = await db.import_jobs.update_one(
+            {"job_id": job_id, "lease_owner": lease},
+            {"$set": {
+                "processed": counts["imported"] + counts["duplicate"] + counts["failed"],
+                "total_imported": counts["imported"],
+                "total_duplicates": counts["duplicate"],
+                "total_failed": counts["failed"],
+                "lease_expires_at": now + timedelta(seconds=IMPORT_LEASE_SECONDS),
+                "updated_at": now
+            }}
+        )
+        if not renewed.matched_count:
+            return
+
+    counts = await import_job_counts(job_id)
+    now = datetime.now(timezone.utc)
+    finished = await db.import_jobs.update_one(
+        {"job_id": job_id, "lease_owner": lease},
+        {"$set": {
+            "status": "completed",
+            "processed": counts["imported"] + counts["duplicate"] + counts["failed"],
+            "total_imported": counts["imported"],
+            "total_duplicates": counts["duplicate"],
+            "total_failed": counts["failed"],
+            "lease_owner": None,
+            "lease_expires_at": None,
+            "finished_at": now,
+            "updated_at": now
+        }}
+    )
+    if finished.modified_count:
+        await expire_import_job_rows(job_id)
+        await invalidate_map_snapshots([owner_id])
+        await publish_event([owner_id], "import_completed", {
+            "job_id": job_id,
+            "total_imported": counts["imported"],
+            "total_duplicates": counts["duplicate"],
+            "total_failed": counts["failed"]
+        })
+
+
+async def expire_import_job_rows(job_id: str):
+    """Let the TTL index drop a finished job's rows after IMPORT_ROWS_RETENTION"""
+    await db.import_job_rows.update_many(
+        {"job_id": job_id},
+        {"$set": {"expires_at": datetime.now(timezone.utc) + timedelta(seconds=IMPORT_ROWS_RETENTION)}}
+    )
+
+
+async def fail_import_job(job: dict, error: str, lease: Optional[str] = None):
+    """End a job that can't complete; rows imported so far are kept"""
+    counts = await import_job_counts(job["job_id"])
+    now = datetime.now(timezone.utc)
+    query = {"job_id": job["job_id"], "status": {"$in": ["queued", "running"]}}
+    if lease is not None:
+        query["lease_owner"] = lease
+    failed = await db.import_jobs.update_one(query, {"$set": {
+        "status": "failed",
+        "error": error,
+        "processed": counts["imported"] + counts["duplicate"] + counts["failed"],
+        "total_imported": counts["imported"],
+        "total_duplicates": counts["duplicate"],
+        "total_failed": counts["failed"],
+        "lease_owner": None,
+        "lease_expires_at": None,
+        "finished_at": now,
+        "updated_at": now
+    }})
+    if failed.modified_count:
+        await expire_import_job_rows(job["job_id"])
+        await invalidate_map_snapshots([job["owner_id"]])
+        await publish_event([job["owner_id"]], "import_failed", {"job_id": job["job_id"], "error": error})
+
+
+class ImportWorkerPool:
+    """Background workers claiming queued import jobs under renewable leases"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.worker_id = f"worker_{uuid.uuid4().hex[:12]}"
+        self.jobs_processed = 0
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.size)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def _claim(self) -> Tuple[Optional[dict], str]:
+        lease = f"{self.worker_id}:{uuid.uuid4().hex[:8]}"
+        now = datetime.now(timezone.utc)
+        # Jobs whose last allowed attempt died with its worker
+        async for job in db.import_jobs.find(
+            {"status": "running", "lease_expires_at": {"$lt": now}, "attempts": {"$gte": IMPORT_MAX_ATTEMPTS}},
+            {"_id": 0, "job_id": 1, "owner_id": 1}
+        ):
+            await fail_import_job(job, f"Gave up after {IMPORT_MAX_ATTEMPTS} attempts")
+        job = await db.import_jobs.find_one_and_update(
+            {
+                "status": {"$in": ["queued", "running"]},
+                "attempts": {"$not": {"$gte": IMPORT_MAX_ATTEMPTS}},
+                "$or": [{"lease_expires_at": None}, {"lease_expires_at": {"$lt": now}}]
+            },
+            {"$set": {
+                "status": "running",
+                "lease_owner": lease,
+                "lease_expires_at": now + timedelta(seconds=IMPORT_LEASE_SECONDS),
+                "updated_at": now
+            }, "$inc": {"attempts": 1}},
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+        return job, lease
+
+    async def _run(self):
+        while True:
+            job = None
+            try:
+                job, lease = await self._claim()
+                if job is not None:
+                    work = asyncio.ensure_future(process_import_job(job, lease))
+                    heartbeat = asyncio.ensure_future(self._heartbeat(job["job_id"], lease, work))
+                    try:
+                        await asyncio.wait({work})
+                    finally:
+                        heartbeat.cancel()
+                        work.cancel()
+                    # Cancelled by the heartbeat: the lease was lost and the job belongs to another worker
+                    if not work.cancelled():
+                        work.result()
+                        self.jobs_processed += 1
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"WARNING: import worker error: {e}")
+                if job is not None:
+                    await self._attempt_failed(job, lease, e)
+            # Idle: wait for a local upload, or poll for other workers' jobs and expired leases
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), IMPORT_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    @staticmethod
+    async def _heartbeat(job_id: str, lease: str, work: asyncio.Future):
+        """Renew the lease for as long as the job runs, even while it waits for a bulk geocode slot"""
+        while True:
+            await asyncio.sleep(IMPORT_LEASE_SECONDS / 3)
+            now = datetime.now(timezone.utc)
+            try:
+                renewed = await db.import_jobs.update_one(
+                    {"job_id": job_id, "lease_owner": lease},
+                    {"$set": {"lease_expires_at": now + timedelta(seconds=IMPORT_LEASE_SECONDS)}}
+                )
+            except Exception as e:
+                print(f"WARNING: could not renew import job lease: {e}")
+                continue
+            if not renewed.matched_count:
+                work.cancel()
+                return
+
+    @staticmethod
+    async def _attempt_failed(job: dict, lease: str, error: Exception):
+        """Give up on the last attempt; otherwise the lease runs out and the job is claimed again"""
+        try:
+            if job.get("attempts", 0) >= IMPORT_MAX_ATTEMPTS:
+                await fail_import_job(job, str(error), lease)
+            else:
+                await db.import_jobs.update_one(
+                    {"job_id": job["job_id"], "lease_owner": lease},
+                    {"$set": {"last_error": str(error)}}
+                )
+        except Exception as e:
+            print(f"WARNING: could not record import job error: {e}")
+
+    def stats(self) -> dict:
+        return {"workers": len(self._tasks), "jobs_processed": self.jobs_processed}
+
+
+import_workers = ImportWorkerPool(IMPORT_WORKERS)
+
+
+@app.post("/api/imported-friends/csv", status_code=202)
 async def import_friends_csv(file: UploadFile = File(...), user: dict = Depends(get_current_user)):
-    """Import friends from CSV file with geocoding"""
-    if not file.filename.endswith('.csv'):
-        raise HTTPException(status_code=400, detail="File must be a CSV")
+    """Queue a CSV, vCard or LinkedIn export ZIP import; poll GET /api/imported-friends/import-jobs/{job_id} for its progress"""
+    file_type = import_file_type(file.filename)
+    if file_type is None:
+        raise HTTPException(status_code=400, detail="File must be a CSV, vCard or ZIP export")
     
-    content = await file.read()
+    job_id = f"import_{uuid.uuid4().hex[:12]}"
+    now = datetime.now(timezone.utc)
     try:
-        # Try different encodings
-        try:
-            text_content = content.decode('utf-8')
-        except UnicodeDecodeError:
-            text_content = content.decode('latin-1')
-        
-        csv_reader = csv.DictReader(io.StringIO(text_content))
-        
-        imported = []
-        failed = []
-        
-        for row in csv_reader:
-            # Handle different column name variations
-            first_name = row.get('Nome') or row.get('nome') or row.get('First Name') or row.get('first_name') or ''
-            last_name = row.get('Cognome') or row.get('cognome') or row.get('Last Name') or row.get('last_name') or ''
-            city = row.get('Città') or row.get('citta') or row.get('City') or row.get('city') or ''
-            email = row.get('Email') or row.get('email') or None
-            phone = row.get('Telefono') or row.get('telefono') or row.get('Phone') or row.get('phone') or None
-            
-            if not first_name or not city:
-                failed.append({
-                    "row": row,
-                    "error": "Missing required fields (Nome/First Name and Città/City)"
-                })
-                continue
-            
-            # Geocode the city
-            geo_result = await geocode_city(city)
-            
-            # Small delay to respect Nominatim rate limits
-            await asyncio.sleep(0.5)
-            
-            friend_id = f"imported_{uuid.uuid4().hex[:12]}"
-            friend_data = {
-                "friend_id": friend_id,
-                "owner_id": user["user_id"],
-                "first_name": first_name.strip(),
-                "last_name": last_name.strip() if last_name else "",
-                "city": city.strip(),
-                "city_lat": geo_result["lat"],
-                "city_lng": geo_result["lng"],
-                "display_name": geo_result["display_name"],
-                "geocode_status": geo_result["status"],
-                "email": email.strip() if email else None,
-                "phone": phone.strip() if phone else None,
-                "photo": None,
-                "created_at": datetime.now(timezone.utc)
-            }
-            
-            await db.imported_friends.insert_one(friend_data)
-            imported.append({
-                "friend_id": friend_id,
-                "name": f"{first_name} {last_name}".strip(),
-                "city": city,
-                "lat": geo_result["lat"],
-                "lng": geo_result["lng"],
-                "geocode_status": geo_result["status"]
-            })
-        
-        return {
-            "message": f"Imported {len(imported)} friends",
-            "imported": imported,
-            "failed": failed,
-            "total_imported": len(imported),
-            "total_failed": len(failed)
-        }
+        total = 0
+        batch = []
+        index = 0
+        async for row, error in import_rows(file, file_type):
+            fields = import_row_fields(row, require_city=file_type == "csv") if error is None else None
+            job_row = {"job_id": job_id, "index": index, "row": row, "created_at": now}
+            if error is not None:
+                job_row.update(status="failed", error=error)
+            elif fields is None:
+                job_row.update(status="failed", error=(
+                    "Missing required fields (Nome/First Name and Città/City)" if file_type == "csv"
+                    else "Missing required field (First Name)"
+                ))
+            else:
+                job_row.update(status="pending", data=fields, friend_id=f"imported_{uuid.uuid4().hex[:12]}")
+            batch.append(job_row)
+            index += 1
+            total += 1
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                await db.import_job_rows.insert_many(batch)
+                batch = []
+        if batch:
+            await db.import_job_rows.insert_many(batch)
+    
+    except Exception as e:
+        await db.import_job_rows.delete_many({"job_id": job_id})
+        raise HTTPException(status_code=400, detail=f"Error parsing {file_type}: {str(e)}")
+
+    # Rows first: a worker may claim the job as soon as it exists
+    await db.import_jobs.insert_one({
+        "job_id": job_id,
+        "owner_id": user["user_id"],
+        "filename": file.filename,
+        "status": "queued",
+        "total": total,
+        "processed": 0,
+        "total_imported": 0,
+        "total_duplicates": 0,
+        "total_failed": 0,
+        "attempts": 0,
+        "lease_owner": None,
+        "lease_expires_at": None,
+        "created_at": now,
+        "updated_at": now
+    })
+    import_workers.wake()
+    return {"message": "Import queued", "job_id": job_id, "status": "queued", "total": total}
+
+IMPORT_JOB_PROJECTION = {"_id": 0, "lease_owner": 0, "lease_expires_at": 0}
+
+
+@app.get("/api/imported-friends/import-jobs")
+async def get_import_jobs(user: dict = Depends(get_current_user)):
+    """Recent import jobs of the current user"""
+    return await db.import_jobs.find(
+        {"owner_id": user["user_id"]},
+        IMPORT_JOB_PROJECTION
+    ).sort("created_at", -1).to_list(20)
+
+@app.get("/api/imported-friends/import-jobs/{job_id}")
+async def get_import_job(job_id: str, user: dict = Depends(get_current_user)):
+    """Progress counters of an import job; per-row results once it has finished"""
+    job = await db.import_jobs.find_one({"job_id": job_id, "owner_id": user["user_id"]}, IMPORT_JOB_PROJECTION)
+    if not job:
+        raise HTTPException(status_code=404, detail="Import job not found")
+    # Polled while the job runs: reading every finished row on each poll would be O(rows)
+    if job["status"] in ("queued", "running"):
+        return job
     
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error parsing CSV: {str(e)}")
+    imported = []
+    duplicates = []
+    failed = []
+    async for row in db.import_job_rows.find(
+        {"job_id": job_id, "status": {"$in": ["imported", "duplicate", "failed"]}},
+        {"_id": 0, "status": 1, "row": 1, "error": 1, "duplicate_of": 1, "friend_id": 1,
+         "data.first_name": 1, "data.last_name": 1, "data.city": 1, "lat": 1, "lng": 1, "geocode_status": 1}
+    ).sort("index", 1):
+        if row["status"] == "failed":
+            failed.append({"row": row["row"], "error": row.get("error")})
+            continue
+        if row["status"] == "duplicate":
+            duplicates.append({"row": row["row"], "duplicate_of": row["duplicate_of"]})
+            continue
+        fields = row["data"]
+        imported.append({
+            "friend_id": row["friend_id"],
+            "name": f"{fields['first_name']} {fields['last_name']}".strip(),
+            "city": fields["city"],
+            "lat": row.get("lat"),
+            "lng": row.get("lng"),
+            "geocode_status": row.get("geocode_status")
+        })
+    return {**job, "imported": imported, "duplicates": duplicates, "failed": failed}
+
+@app.get("/api/imported-friends/duplicates")
+async def get_imported_friend_duplicates(user: dict = Depends(get_current_user)):
+    """Groups of imported friends that look like the same person, oldest first in each group"""
+    groups = await find_duplicate_groups(user["user_id"])
+    return [
+        {
+            "exact": len({friend["fingerprint"] for friend in group}) == 1,
+            "friends": [{k: v for k, v in friend.items() if k != "fingerprint"} for friend in group]
+        }
+        for group in groups
+    ]
 
 @app.get("/api/imported-friends")
-async def get_imported_friends(user: dict = Depends(get_current_user)):
-    """Get all imported friends for current user"""
+async def get_imported_friends(user: dict = Depends(get_current_user), limit: Optional[int] = None, after: Optional[str] = None):
+    """Get imported friends for current user; `limit`/`after` switch to a cursor-paginated page"""
+    if limit is None and after is None:
+        friends = await db.imported_friends.find(
+            {"owner_id": user["user_id"]},
+            IMPORTED_PROJECTION
+        ).to_list(None)
+        return friends
+
+    # Keyset page over the (owner_id, created_at, friend_id) index
+    size = page_size(limit)
+    query = {"owner_id": user["user_id"]}
+    if after:
+        cursor = decode_cursor(after)
+        created_at = cursor_datetime(cursor.get("created_at"))
+        query["$or"] = [
+            {"created_at": {"$gt": created_at}},
+            {"created_at": created_at, "friend_id": {"$gt": cursor.get("friend_id", "")}}
+        ]
     friends = await db.imported_friends.find(
-        {"owner_id": user["user_id"]},
-        {"_id": 0}
-    ).to_list(1000)
-    return friends
+        query,
+        IMPORTED_PROJECTION
+    ).sort([("created_at", 1), ("friend_id", 1)]).limit(size + 1).to_list(None)
+    has_more = len(friends) > size
+    friends = friends[:size]
+    return {
+        "items": friends,
+        "next_cursor": encode_cursor({
+            "created_at": friends[-1]["created_at"],
+            "friend_id": friends[-1]["friend_id"]
+        }) if has_more else None
+    }
 
 @app.post("/api/imported-friends")
 async def add_imported_friend(friend: ImportedFriendCreate, user: dict = Depends(get_current_user)):
@@ -512,8 +2885,13 @@ async def add_imported_friend(friend: ImportedFriendCreate, user: dict = Depends
         "photo": friend.photo,
         "created_at": datetime.now(timezone.utc)
     }
+    friend_data.update(friend_dedup_fields(friend_data))
+    location = geo_point(city_lat, city_lng)
+    if location:
+        friend_data["location"] = location
     
     await db.imported_friends.insert_one(friend_data)
+    await patch_map_snapshots([user["user_id"]], f"i:{friend_id}", imported_snapshot_entry(friend_data))
     
     return {
         "friend_id": friend_id,
@@ -524,69 +2902,88 @@ async def add_imported_friend(friend: ImportedFriendCreate, user: dict = Depends
         "geocode_status": geocode_status
     }
 
-@app.get("/api/imported-friends/map")
-async def get_imported_friends_for_map(user: dict = Depends(get_current_user)):
-    """Get imported friends with location data for map"""
-    friends = await db.imported_friends.find(
-        {"owner_id": user["user_id"], "city_lat": {"$ne": None}},
-        {"_id": 0}
-    ).to_list(1000)
-    
-    map_data = []
-    for friend in friends:
-        map_data.append({
-            "friend_id": friend["friend_id"],
-            "name": f"{friend['first_name']} {friend.get('last_name', '')}".strip(),
-            "city": friend["city"],
-            "lat": friend["city_lat"],
-            "lng": friend["city_lng"],
-            "email": friend.get("email"),
-            "phone": friend.get("phone"),
-            "photo": friend.get("photo"),
-            "geocode_status": friend.get("geocode_status", "success"),
-            "marker_type": "imported"
-        })
-    return map_data
+# Same scope as /api/friends/map: background imports and geocoding change it at any time
+@app.get("/api/imported-friends/map", dependencies=[Depends(conditional_get("map", cache_control="private, no-cache"))])
+async def get_imported_friends_for_map(request: Request, user: dict = Depends(get_current_user), bbox: Optional[str] = None):
+    """Get imported friends with location data for map, optionally only inside a bbox viewport"""
+    if bbox:
+        friends = await find_located_imported_friends(user["user_id"], parse_bbox(bbox))
+    else:
+        _, friends = snapshot_sources(await get_map_snapshot(user["user_id"]))
+    return map_response(request, [imported_friend_marker(friend) for friend in friends])
 
 @app.put("/api/imported-friends/{friend_id}")
 async def update_imported_friend(friend_id: str, update: ImportedFriendUpdate, user: dict = Depends(get_current_user)):
     """Update an imported friend (including manual position)"""
     update_data = {k: v for k, v in update.model_dump().items() if v is not None}
     
-    if update_data:
-        result = await db.imported_friends.update_one(
+    if not update_data:
+        friend = await db.imported_friends.find_one(
             {"friend_id": friend_id, "owner_id": user["user_id"]},
-            {"$set": update_data}
+            IMPORTED_PROJECTION
         )
-        if result.matched_count == 0:
+        if not friend:
             raise HTTPException(status_code=404, detail="Friend not found")
-    
-    friend = await db.imported_friends.find_one(
+        return friend
+
+    update_doc = {"$set": update_data}
+    if "city_lat" in update_data or "city_lng" in update_data:
+        coords = update_data
+        if "city_lat" not in update_data or "city_lng" not in update_data:
+            current = await db.imported_friends.find_one(
+                {"friend_id": friend_id, "owner_id": user["user_id"]},
+                {"_id": 0, "city_lat": 1, "city_lng": 1}
+            ) or {}
+            coords = {**current, **update_data}
+        update_doc = geo_update({"location": geo_point(coords.get("city_lat"), coords.get("city_lng"))})
+        update_doc["$set"] = {**update_doc.get("$set", {}), **update_data}
+
+    friend = await db.imported_friends.find_one_and_update(
         {"friend_id": friend_id, "owner_id": user["user_id"]},
-        {"_id": 0}
+        update_doc,
+        projection=IMPORTED_PROJECTION,
+        return_document=ReturnDocument.AFTER
     )
+    if not friend:
+        raise HTTPException(status_code=404, detail="Friend not found")
+    if update_data.keys() & {"first_name", "last_name", "city", "email", "phone"}:
+        await db.imported_friends.update_one(
+            {"friend_id": friend_id},
+            {"$set": friend_dedup_fields(friend)}
+        )
+    await patch_map_snapshots([user["user_id"]], f"i:{friend_id}", imported_snapshot_entry(friend))
     return friend
 
+@app.post("/api/imported-friends/geocode-failed")
+async def geocode_failed_imported_friends(user: dict = Depends(get_current_user)):
+    """Re-geocode every imported friend whose geocoding failed, streaming NDJSON results"""
+    friends = await db.imported_friends.find(
+        {"owner_id": user["user_id"], "geocode_status": "failed"},
+        {"_id": 0, "friend_id": 1, "city": 1}
+    ).to_list(None)
+    return StreamingResponse(
+        geocode_batch_lines(user["user_id"], [], friends, [], lane="bulk"),
+        media_type="application/x-ndjson"
+    )
+
 @app.post("/api/imported-friends/{friend_id}/geocode")
 async def geocode_imported_friend(friend_id: str, user: dict = Depends(get_current_user)):
     """Re-geocode a specific imported friend"""
     friend = await db.imported_friends.find_one(
         {"friend_id": friend_id, "owner_id": user["user_id"]},
-        {"_id": 0}
+        IMPORTED_PROJECTION
     )
     if not friend:
         raise HTTPException(status_code=404, detail="Friend not found")
     
     geo_result = await geocode_city(friend["city"])
     
-    await db.imported_friends.update_one(
-        {"friend_id": friend_id},
-        {"$set": {
-            "city_lat": geo_result["lat"],
-            "city_lng": geo_result["lng"],
-            "display_name": geo_result["display_name"],
-            "geocode_status": geo_result["status"]
-        }}
+    update_doc = imported_geocode_update(geo_result)
+    await db.imported_friends.update_one({"friend_id": friend_id}, update_doc)
+    await patch_map_snapshots(
+        [user["user_id"]],
+        f"i:{friend_id}",
+        imported_snapshot_entry({**friend, **update_doc["$set"]})
     )
     
     return {
@@ -604,6 +3001,7 @@ async def delete_imported_friend(friend_id: str, user: dict = Depends(get_curren
     )
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Friend not found")
+    await patch_map_snapshots([user["user_id"]], f"i:{friend_id}", None)
     return {"message": "Friend deleted"}
 
 @app.post("/api/geocode")
@@ -617,6 +3015,99 @@ async def geocode_single_city(request: Request, user: dict = Depends(get_current
     result = await geocode_city(city_name)
     return result
 
+def imported_geocode_update(geo_result: dict) -> dict:
+    """Update document storing a geocoding result on imported friends"""
+    update_doc = geo_update({"location": geo_point(geo_result["lat"], geo_result["lng"])})
+    update_doc["$set"] = {
+        **update_doc.get("$set", {}),
+        "city_lat": geo_result["lat"],
+        "city_lng": geo_result["lng"],
+        "display_name": geo_result["display_name"],
+        "geocode_status": geo_result["status"]
+    }
+    return update_doc
+
+
+def ndjson_line(data: dict) -> str:
+    return json.dumps(data, separators=(",", ":")) + "\n"
+
+
+async def geocode_batch_lines(owner_id: str, cities: List[str], friends: List[dict], missing_ids: List[str],
+                              lane: Optional[str] = None) -> AsyncIterator[str]:
+    """Resolve each distinct city once, yielding NDJSON results as lookups complete.
+
+    Friends sharing a city are updated together; without an explicit lane, small
+    batches use the interactive one."""
+    for friend_id in missing_ids:
+        yield ndjson_line({"friend_id": friend_id, "error": "Friend not found"})
+
+    targets: Dict[str, dict] = {}
+    for city in cities:
+        target = targets.setdefault(geocode_cache_key(city), {"city": city, "spellings": [], "friends": []})
+        if city not in target["spellings"]:
+            target["spellings"].append(city)
+    for friend in friends:
+        target = targets.setdefault(geocode_cache_key(friend.get("city") or ""),
+                                    {"city": friend.get("city") or "", "spellings": [], "friends": []})
+        target["friends"].append(friend["friend_id"])
+    if lane is None:
+        lane = "interactive" if len(targets) <= GEOCODE_BATCH_INTERACTIVE else "bulk"
+
+    async def resolve(target: dict) -> Tuple[dict, dict]:
+        return target, await geocode_city(target["city"], lane=lane)
+
+    tasks = [asyncio.ensure_future(resolve(target)) for target in targets.values()]
+    updated = False
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            target, geo_result = await next_done
+            for city in target["spellings"]:
+                yield ndjson_line({**geo_result, "city": city})
+            if target["friends"]:
+                await db.imported_friends.update_many(
+                    {"owner_id": owner_id, "friend_id": {"$in": target["friends"]}},
+                    imported_geocode_update(geo_result)
+                )
+                updated = True
+                for friend_id in target["friends"]:
+                    yield ndjson_line({
+                        "friend_id": friend_id,
+                        "lat": geo_result["lat"],
+                        "lng": geo_result["lng"],
+                        "geocode_status": geo_result["status"]
+                    })
+    finally:
+        # Client went away: a lookup no other caller shares is cancelled upstream too
+        # (SingleFlight stops it with its last waiter), freeing its rate-limiter slot
+        for task in tasks:
+            task.cancel()
+        # One invalidation per batch, not per city
+        if updated:
+            await invalidate_map_snapshots([owner_id])
+
+
+@app.post("/api/geocode/batch")
+async def geocode_batch(batch: GeocodeBatchRequest, user: dict = Depends(get_current_user)):
+    """Geocode many city names and/or imported friends at once, streaming NDJSON results as they complete"""
+    cities = list(dict.fromkeys(city.strip() for city in batch.cities if city and city.strip()))
+    friend_ids = list(dict.fromkeys(batch.friend_ids))
+    if not cities and not friend_ids:
+        raise HTTPException(status_code=400, detail="City names or friend ids required")
+    if len(cities) + len(friend_ids) > GEOCODE_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {GEOCODE_BATCH_MAX} cities and friends per batch")
+
+    friends = await db.imported_friends.find(
+        {"owner_id": user["user_id"], "friend_id": {"$in": friend_ids}},
+        {"_id": 0, "friend_id": 1, "city": 1}
+    ).to_list(None) if friend_ids else []
+    found = {friend["friend_id"] for friend in friends}
+    return StreamingResponse(
+        geocode_batch_lines(
+            user["user_id"], cities, friends, [friend_id for friend_id in friend_ids if friend_id not in found]
+        ),
+        media_type="application/x-ndjson"
+    )
+
 # ============== MEETUPS ENDPOINTS ==============
 
 @app.post("/api/meetups")
@@ -635,32 +3126,44 @@ async def create_meetup(meetup: MeetupCreate, user: dict = Depends(get_current_u
         "invited_user_ids": meetup.invited_user_ids,
         "attendee_ids": [user["user_id"]],
         "status": "active",
+        "location": geo_point(meetup.city_lat, meetup.city_lng),
         "created_at": datetime.now(timezone.utc)
     })
     return {"message": "Meetup created", "meetup_id": meetup_id}
 
 @app.get("/api/meetups")
-async def get_meetups(user: dict = Depends(get_current_user)):
-    """Get user's meetups"""
-    meetups = await db.meetups.find(
-        {"$or": [
-            {"creator_id": user["user_id"]},
-            {"invited_user_ids": user["user_id"]},
-            {"attendee_ids": user["user_id"]}
-        ]},
-        {"_id": 0}
-    ).to_list(100)
+async def get_meetups(user: dict = Depends(get_current_user), bbox: Optional[str] = None):
+    """Get user's meetups, optionally only those inside a bbox viewport"""
+    query = {"$or": [
+        {"creator_id": user["user_id"]},
+        {"invited_user_ids": user["user_id"]},
+        {"attendee_ids": user["user_id"]}
+    ]}
+    viewport = parse_bbox(bbox) if bbox else None
+    geo_filter = bbox_geo_filter(viewport) if viewport else None
+    if geo_filter:
+        query = {"$and": [query, {"location": geo_filter}]}
+    meetups = await db.meetups.find(query, MEETUP_PROJECTION).to_list(100)
+    if viewport:
+        meetups = [m for m in meetups if point_in_bbox(m["city_lat"], m["city_lng"], viewport)]
     return meetups
 
 @app.post("/api/meetups/{meetup_id}/join")
 async def join_meetup(meetup_id: str, user: dict = Depends(get_current_user)):
     """Join a meetup"""
-    result = await db.meetups.update_one(
-        {"meetup_id": meetup_id},
-        {"$addToSet": {"attendee_ids": user["user_id"]}}
+    meetup = await db.meetups.find_one_and_update(
+        {"meetup_id": meetup_id, "attendee_ids": {"$ne": user["user_id"]}},
+        {"$addToSet": {"attendee_ids": user["user_id"]}},
+        projection={"_id": 0, "creator_id": 1, "title": 1}
     )
-    if result.modified_count == 0:
+    if not meetup:
         raise HTTPException(status_code=404, detail="Meetup not found")
+    if meetup.get("creator_id") != user["user_id"]:
+        await publish_event([meetup["creator_id"]], "meetup_joined", {
+            "meetup_id": meetup_id,
+            "title": meetup.get("title"),
+            "user": {k: user.get(k) for k in PROFILE_SUMMARY_FIELDS}
+        })
     return {"message": "Joined meetup"}
 
 @app.delete("/api/meetups/{meetup_id}")
@@ -673,74 +3176,361 @@ async def delete_meetup(meetup_id: str, user: dict = Depends(get_current_user)):
         raise HTTPException(status_code=404, detail="Meetup not found or not authorized")
     return {"message": "Meetup deleted"}
 
+# ============== CONVERSATIONS ==============
+#
+# Every message carries the conversation_id of its user pair. `conversations`
+# keeps one summary per pair (participants, last message, per-user unread count)
+# so the conversation list never scans messages; threads and mailboxes are read
+# with keyset pages over (created_at, message_id).
+#
+# Unread counts live in conversations.unread.<user_id> and, as a per-user total,
+# in unread_counters {_id: user_id, total}. Both move in the same transaction as
+# the message writes, by exactly the number of messages that changed state;
+# execution/reconcile_unread_counters.py rebuilds them from the messages.
+
+def conversation_id_for(user_a: str, user_b: str) -> str:
+    """Stable id of the conversation between two users"""
+    return f"conv_{hashlib.sha1(friendship_pair_key(user_a, user_b).encode()).hexdigest()[:16]}"
+
+
+def message_summary(message: dict) -> dict:
+    return {
+        "message_id": message["message_id"],
+        "from_user_id": message["from_user_id"],
+        "content": message["content"],
+        "message_type": message.get("message_type"),
+        "created_at": message["created_at"]
+    }
+
+
+async def adjust_unread(user_id: str, conversation_id: str, delta: int, session=None):
+    await db.conversations.update_one(
+        {"conversation_id": conversation_id},
+        {"$inc": {f"unread.{user_id}": delta}},
+        session=session
+    )
+    await db.unread_counters.update_one(
+        {"_id": user_id},
+        {"$inc": {"total": delta}},
+        upsert=True,
+        session=session
+    )
+
+
+async def message_page(query: dict, limit: Optional[int], before: Optional[str] = None, after: Optional[str] = None) -> dict:
+    """Keyset page of messages: newest first, or oldest first when reading forward from `after`"""
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+    size = page_size(limit)
+    direction = 1 if after else -1
+    if before or after:
+        cursor = decode_cursor(before or after)
+        created_at = cursor_datetime(cursor.get("created_at"))
+        op = "$gt" if after else "$lt"
+        query = {**query, "$or": [
+            {"created_at": {op: created_at}},
+            {"created_at": created_at, "message_id": {op: cursor.get("message_id", "")}}
+        ]}
+    messages = await db.messages.find(
+        query,
+        {"_id": 0}
+    ).sort([("created_at", direction), ("message_id", direction)]).limit(size + 1).to_list(None)
+    has_more = len(messages) > size
+    messages = messages[:size]
+    return {
+        "items": messages,
+        "next_cursor": encode_cursor({
+            "created_at": messages[-1]["created_at"],
+            "message_id": messages[-1]["message_id"]
+        }) if has_more else None
+    }
+
 # ============== MESSAGES ENDPOINTS ==============
 
 @app.post("/api/messages")
 async def send_message(msg: MessageCreate, user: dict = Depends(get_current_user)):
     """Send a message"""
     message_id = f"msg_{uuid.uuid4().hex[:12]}"
-    await db.messages.insert_one({
+    conversation_id = conversation_id_for(user["user_id"], msg.to_user_id)
+    now = datetime.now(timezone.utc)
+    message = {
         "message_id": message_id,
+        "conversation_id": conversation_id,
         "from_user_id": user["user_id"],
         "to_user_id": msg.to_user_id,
         "content": msg.content,
         "message_type": msg.message_type,
         "read": False,
-        "created_at": datetime.now(timezone.utc)
+        "created_at": now
+    }
+
+    async def send(session):
+        await db.messages.insert_one(message, session=session)
+        await db.conversations.update_one(
+            {"conversation_id": conversation_id},
+            {
+                "$set": {"last_message": message_summary(message), "last_message_at": now},
+                "$setOnInsert": {"user_ids": sorted({user["user_id"], msg.to_user_id}), "created_at": now}
+            },
+            upsert=True,
+            session=session
+        )
+        await adjust_unread(msg.to_user_id, conversation_id, 1, session)
+
+    await run_transaction(send)
+    await bump_data_versions([msg.to_user_id], "inbox")
+    await publish_event([msg.to_user_id], "message", {
+        **message_summary(message),
+        "conversation_id": conversation_id,
+        "from_user": {k: user.get(k) for k in PROFILE_SUMMARY_FIELDS}
     })
-    return {"message": "Message sent", "message_id": message_id}
+    return {"message": "Message sent", "message_id": message_id, "conversation_id": conversation_id}
 
-@app.get("/api/messages/inbox")
-async def get_inbox(user: dict = Depends(get_current_user)):
-    """Get inbox messages"""
-    messages = await db.messages.find(
-        {"to_user_id": user["user_id"]},
-        {"_id": 0}
-    ).sort("created_at", -1).to_list(100)
+# Incoming messages must show on the next poll: always revalidate
+@app.get("/api/messages/inbox", dependencies=[Depends(conditional_get("inbox", cache_control="private, no-cache"))])
+async def get_inbox(
+    user: dict = Depends(get_current_user),
+    loader: UserLoader = Depends(get_user_loader),
+    limit: Optional[int] = None,
+    before: Optional[str] = None
+):
+    """Get inbox messages; `limit`/`before` switch to a cursor-paginated page"""
+    if limit is None and before is None:
+        messages = await db.messages.find(
+            {"to_user_id": user["user_id"]},
+            {"_id": 0}
+        ).sort("created_at", -1).to_list(100)
+        page = None
+    else:
+        page = await message_page({"to_user_id": user["user_id"]}, limit, before=before)
+        messages = page["items"]
+    senders = await loader.load_many(msg["from_user_id"] for msg in messages)
     
-    result = []
-    for msg in messages:
-        sender = await db.users.find_one({"user_id": msg["from_user_id"]}, {"_id": 0})
-        result.append({
-            **msg,
-            "from_user": sender
-        })
-    return result
+    messages = [{**msg, "from_user": senders.get(msg["from_user_id"])} for msg in messages]
+    if page is None:
+        return messages
+    return {**page, "items": messages}
 
 @app.get("/api/messages/sent")
-async def get_sent_messages(user: dict = Depends(get_current_user)):
-    """Get sent messages"""
-    messages = await db.messages.find(
-        {"from_user_id": user["user_id"]},
-        {"_id": 0}
-    ).sort("created_at", -1).to_list(100)
-    return messages
+async def get_sent_messages(user: dict = Depends(get_current_user), limit: Optional[int] = None, before: Optional[str] = None):
+    """Get sent messages; `limit`/`before` switch to a cursor-paginated page"""
+    if limit is None and before is None:
+        messages = await db.messages.find(
+            {"from_user_id": user["user_id"]},
+            {"_id": 0}
+        ).sort("created_at", -1).to_list(100)
+        return messages
+    return await message_page({"from_user_id": user["user_id"]}, limit, before=before)
 
 @app.put("/api/messages/{message_id}/read")
 async def mark_message_read(message_id: str, user: dict = Depends(get_current_user)):
     """Mark message as read"""
-    await db.messages.update_one(
-        {"message_id": message_id, "to_user_id": user["user_id"]},
-        {"$set": {"read": True}}
-    )
+    async def mark(session):
+        message = await db.messages.find_one_and_update(
+            {"message_id": message_id, "to_user_id": user["user_id"], "read": False},
+            {"$set": {"read": True}},
+            projection={"_id": 0, "conversation_id": 1},
+            session=session
+        )
+        if message:
+            await adjust_unread(user["user_id"], message["conversation_id"], -1, session)
+        return message
+
+    if await run_transaction(mark):
+        await bump_data_versions([user["user_id"]], "inbox")
     return {"message": "Marked as read"}
 
+@app.get("/api/messages/unread-count")
+async def get_unread_count(user: dict = Depends(get_current_user)):
+    """Total unread messages, read from the per-user counter"""
+    counter = await db.unread_counters.find_one({"_id": user["user_id"]})
+    return {"unread_count": max(0, (counter or {}).get("total", 0))}
+
+@app.get("/api/conversations")
+async def get_conversations(
+    user: dict = Depends(get_current_user),
+    loader: UserLoader = Depends(get_user_loader),
+    limit: Optional[int] = None,
+    after: Optional[str] = None
+):
+    """List the user's conversations, most recently active first"""
+    # Keyset page over the (user_ids, last_message_at, conversation_id) index
+    size = page_size(limit)
+    query = {"user_ids": user["user_id"]}
+    if after:
+        cursor = decode_cursor(after)
+        last_message_at = cursor_datetime(cursor.get("last_message_at"))
+        query["$or"] = [
+            {"last_message_at": {"$lt": last_message_at}},
+            {"last_message_at": last_message_at, "conversation_id": {"$lt": cursor.get("conversation_id", "")}}
+        ]
+    conversations = await db.conversations.find(
+        query,
+        {"_id": 0}
+    ).sort([("last_message_at", -1), ("conversation_id", -1)]).limit(size + 1).to_list(None)
+    has_more = len(conversations) > size
+    conversations = conversations[:size]
+
+    def other_user_id(conversation):
+        others = [uid for uid in conversation["user_ids"] if uid != user["user_id"]]
+        return others[0] if others else user["user_id"]
+
+    profiles = await loader.load_many(other_user_id(c) for c in conversations)
+    items = [{
+        "conversation_id": c["conversation_id"],
+        "user": profiles.get(other_user_id(c)),
+        "last_message": c.get("last_message"),
+        "last_message_at": c.get("last_message_at"),
+        "unread_count": c.get("unread", {}).get(user["user_id"], 0)
+    } for c in conversations]
+    return {
+        "items": items,
+        "next_cursor": encode_cursor({
+            "last_message_at": conversations[-1]["last_message_at"],
+            "conversation_id": conversations[-1]["conversation_id"]
+        }) if has_more else None
+    }
+
+@app.get("/api/conversations/{conversation_id}/messages")
+async def get_conversation_messages(
+    conversation_id: str,
+    user: dict = Depends(get_current_user),
+    limit: Optional[int] = None,
+    before: Optional[str] = None,
+    after: Optional[str] = None
+):
+    """Page through one conversation: newest first, or forward in time with `after`"""
+    conversation = await db.conversations.find_one(
+        {"conversation_id": conversation_id, "user_ids": user["user_id"]},
+        {"_id": 1}
+    )
+    if not conversation:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return await message_page({"conversation_id": conversation_id}, limit, before=before, after=after)
+
+@app.put("/api/conversations/{conversation_id}/read")
+async def mark_conversation_read(conversation_id: str, req: MarkReadRequest, user: dict = Depends(get_current_user)):
+    """Mark every received message of a conversation read, optionally only up to a cursor or timestamp"""
+    query = {"conversation_id": conversation_id, "to_user_id": user["user_id"], "read": False}
+    if req.cursor:
+        cursor = decode_cursor(req.cursor)
+        created_at = cursor_datetime(cursor.get("created_at"))
+        query["$or"] = [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "message_id": {"$lte": cursor.get("message_id", "")}}
+        ]
+    elif req.up_to:
+        query["created_at"] = {"$lte": req.up_to}
+
+    async def mark(session):
+        result = await db.messages.update_many(query, {"$set": {"read": True}}, session=session)
+        if result.modified_count:
+            await adjust_unread(user["user_id"], conversation_id, -result.modified_count, session)
+        return result.modified_count
+
+    marked = await run_transaction(mark)
+    if marked:
+        await bump_data_versions([user["user_id"]], "inbox")
+    return {"message": "Marked as read", "marked_read": marked}
+
+# ============== SEARCH INDEX ==============
+#
+# user_search_index holds, per user, the normalized tokens of name and email and
+# every edge n-gram (prefix) of them under a multikey index, so a typeahead
+# query is an index lookup on its tokens instead of a regex scan of users.
+
+def normalize_search_text(text: Optional[str]) -> str:
+    """Case-fold and strip accents ("Élodie" -> "elodie")"""
+    decomposed = unicodedata.normalize("NFKD", (text or "").casefold())
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+def search_tokens(text: Optional[str]) -> List[str]:
+    return [token for token in re.split(r"\W+", normalize_search_text(text)) if token]
+
+
+def edge_ngrams(tokens: List[str]) -> List[str]:
+    grams = set()
+    for token in tokens:
+        for end in range(1, min(len(token), SEARCH_MAX_GRAM) + 1):
+            grams.add(token[:end])
+    return sorted(grams)
+
+
+async def index_user_for_search(user: dict):
+    name_tokens = search_tokens(user.get("name"))
+    email_tokens = search_tokens(user.get("email"))
+    await db.user_search_index.update_one(
+        {"user_id": user["user_id"]},
+        {"$set": {
+            "name": normalize_search_text(user.get("name")),
+            "email": normalize_search_text(user.get("email")),
+            "name_tokens": name_tokens,
+            "email_tokens": email_tokens,
+            "grams": edge_ngrams(name_tokens + email_tokens)
+        }},
+        upsert=True
+    )
+
+
+def search_score(entry: dict, query: str, tokens: List[str]) -> Tuple:
+    """Sort key: exact name/email, then whole-name prefix, then token matches; shorter names first"""
+    name, email = entry.get("name", ""), entry.get("email", "")
+    name_tokens = entry.get("name_tokens", [])
+    all_tokens = name_tokens + entry.get("email_tokens", [])
+    exact_tokens = sum(1 for t in tokens if t in all_tokens)
+    name_hits = sum(1 for t in tokens if any(nt.startswith(t) for nt in name_tokens))
+    return (
+        -(name == query or email == query),
+        -name.startswith(query),
+        -exact_tokens,
+        -name_hits,
+        -email.startswith(query),
+        len(name),
+        name
+    )
+
 # ============== SEARCH ENDPOINTS ==============
 
 @app.get("/api/search/users")
 async def search_users(q: str, user: dict = Depends(get_current_user)):
     """Search users by name or email"""
+    tokens = search_tokens(q)
+    if not tokens:
+        return []
+    query = normalize_search_text(q).strip()
+    # One capped query per match tier, strongest first, so the best matches are
+    # always among the candidates however common the prefix is ("mar")
+    tiers = [
+        {"$or": [{"name": query}, {"email": query}]},
+        {"name": {"$regex": f"^{re.escape(query)}"}},
+        {"$or": [{"name_tokens": {"$all": tokens}}, {"email_tokens": {"$all": tokens}}]},
+        # Grams are capped at SEARCH_MAX_GRAM; longer tokens are checked on the stored tokens
+        {"grams": {"$all": [t[:SEARCH_MAX_GRAM] for t in tokens]}},
+    ]
+    results = await asyncio.gather(*(
+        db.user_search_index.find(
+            {**tier, "user_id": {"$ne": user["user_id"]}},
+            {"_id": 0, "grams": 0}
+        ).to_list(SEARCH_CANDIDATES)
+        for tier in tiers
+    ))
+    candidates = {}
+    for tier_candidates in results:
+        for c in tier_candidates:
+            candidates.setdefault(c["user_id"], c)
+    candidates = [
+        c for c in candidates.values()
+        if all(any(ct.startswith(t) for ct in c.get("name_tokens", []) + c.get("email_tokens", [])) for t in tokens)
+    ]
+    ranked = sorted(candidates, key=lambda c: search_score(c, query, tokens))[:20]
+
     users = await db.users.find(
-        {"$and": [
-            {"user_id": {"$ne": user["user_id"]}},
-            {"$or": [
-                {"name": {"$regex": q, "$options": "i"}},
-                {"email": {"$regex": q, "$options": "i"}}
-            ]}
-        ]},
-        {"_id": 0}
-    ).to_list(20)
-    return users
+        {"user_id": {"$in": [c["user_id"] for c in ranked]}},
+        USER_PROJECTION
+    ).to_list(None)
+    by_id = {u["user_id"]: u for u in users}
+    return [by_id[c["user_id"]] for c in ranked if c["user_id"] in by_id]
 
 # ============== GROUP ENDPOINTS ==============
 
@@ -763,10 +3553,13 @@ async def create_group(group: GroupCreate, user: dict = Depends(get_current_user
         "imported_member_ids": [],
         "created_at": datetime.now(timezone.utc)
     })
+    await on_groups_changed(user["user_id"])
     return {"message": "Group created", "group_id": group_id}
 
 
-@app.get("/api/groups")
+# Only the owner's own writes change it, but the dashboard refetches right after them:
+# a max-age would answer that refetch with the stale list, so revalidate (a 304 is one read)
+@app.get("/api/groups", dependencies=[Depends(conditional_get("groups", cache_control="private, no-cache"))])
 async def get_groups(user: dict = Depends(get_current_user)):
     """Get all groups for current user"""
     groups = await db.groups.find(
@@ -799,6 +3592,7 @@ async def update_group(group_id: str, update: GroupUpdate, user: dict = Depends(
         )
         if result.matched_count == 0:
             raise HTTPException(status_code=404, detail="Group not found")
+        await on_groups_changed(user["user_id"])
     
     group = await db.groups.find_one(
         {"group_id": group_id, "owner_id": user["user_id"]},
@@ -815,6 +3609,7 @@ async def delete_group(group_id: str, user: dict = Depends(get_current_user)):
     )
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Group not found")
+    await on_groups_changed(user["user_id"])
     return {"message": "Group deleted"}
 
 
@@ -830,10 +3625,8 @@ async def add_group_member(group_id: str, member: GroupMemberAdd, user: dict = D
     if member.member_type == "user":
         # Verify it's a friend
         friendship = await db.friendships.find_one({
-            "$or": [
-                {"user_id": user["user_id"], "friend_id": member.member_id, "status": "accepted"},
-                {"user_id": member.member_id, "friend_id": user["user_id"], "status": "accepted"}
-            ]
+            "pair_key": friendship_pair_key(user["user_id"], member.member_id),
+            "status": "accepted"
         })
         if not friendship:
             raise HTTPException(status_code=400, detail="User is not a friend")
@@ -858,6 +3651,7 @@ async def add_group_member(group_id: str, member: GroupMemberAdd, user: dict = D
     else:
         raise HTTPException(status_code=400, detail="Invalid member_type")
     
+    await on_groups_changed(user["user_id"])
     return {"message": "Member added to group"}
 
 
@@ -875,84 +3669,545 @@ async def remove_group_member(group_id: str, member_id: str, user: dict = Depend
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Group not found")
+    await on_groups_changed(user["user_id"])
     return {"message": "Member removed from group"}
 
 
 @app.get("/api/friends/map/grouped")
-async def get_friends_for_map_with_groups(user: dict = Depends(get_current_user)):
-    """Get friends with location and group info for map"""
-    # Get all groups
+async def get_friends_for_map_with_groups(request: Request, user: dict = Depends(get_current_user), bbox: Optional[str] = None):
+    """Get friends with location and group info for map, optionally only inside a bbox viewport"""
+    if not bbox:
+        snapshot = await get_map_snapshot(user["user_id"])
+        return map_response(request, grouped_map_markers(*snapshot_sources(snapshot), snapshot["groups"]))
+
+    viewport = parse_bbox(bbox)
     groups = await db.groups.find(
         {"owner_id": user["user_id"]},
         {"_id": 0}
     ).to_list(100)
-    
-    # Create lookup dictionaries
-    user_groups = {}  # user_id -> [group_info]
-    imported_groups = {}  # friend_id -> [group_info]
-    
-    for group in groups:
-        group_info = {
-            "group_id": group["group_id"],
-            "name": group["name"],
-            "color": group["color"]
-        }
-        for uid in group.get("member_ids", []):
-            if uid not in user_groups:
-                user_groups[uid] = []
-            user_groups[uid].append(group_info)
-        
-        for fid in group.get("imported_member_ids", []):
-            if fid not in imported_groups:
-                imported_groups[fid] = []
-            imported_groups[fid].append(group_info)
-    
-    # Get regular map data
-    friends = await get_friends(user)
-    map_data = []
-    
-    for friend in friends:
-        if friend.get("active_city_lat") and friend.get("active_city_lng"):
-            friend_groups = user_groups.get(friend["user_id"], [])
-            map_data.append({
-                "user_id": friend["user_id"],
-                "name": friend["name"],
-                "picture": friend.get("picture"),
-                "bio": friend.get("bio"),
-                "active_city": friend.get("active_city"),
-                "lat": friend["active_city_lat"],
-                "lng": friend["active_city_lng"],
-                "competent_cities": friend.get("competent_cities", []),
-                "availability": friend.get("availability", []),
-                "marker_type": "active",
-                "groups": friend_groups,
-                "marker_color": friend_groups[0]["color"] if friend_groups else None
+    friends = await load_friend_users(user["user_id"], viewport)
+    imported = await find_located_imported_friends(user["user_id"], viewport)
+    map_data = grouped_map_markers(friends, imported, groups)
+    return map_response(request, [m for m in map_data if point_in_bbox(m["lat"], m["lng"], viewport)])
+
+
+# ============== MAP SNAPSHOTS ==============
+#
+# map_snapshots holds, per user, everything needed to draw their map:
+#   markers: {"u:<user_id>": friend fields, "i:<friend_id>": imported friend fields}
+#   groups:  the owner's groups with their member lists
+# Writes patch the affected snapshots in place and bump `version`; a missing or
+# `stale` snapshot is rebuilt on the next read. A snapshot whose content would
+# exceed MAP_SNAPSHOT_MAX_BYTES is stored `oversized`, without markers: it only
+# tracks the version and its content is rebuilt from the live query on each read.
+
+MAP_SNAPSHOT_GROUP_PROJECTION = {"_id": 0, "group_id": 1, "name": 1, "color": 1, "member_ids": 1, "imported_member_ids": 1}
+
+
+def as_utc(value: datetime) -> datetime:
+    """MongoDB hands back naive UTC datetimes"""
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+def friend_snapshot_entry(friend: dict) -> Optional[dict]:
+    """Snapshot fields for a registered friend, None if they have no marker to draw"""
+    if not active_friend_marker(friend) and not competent_friend_markers(friend):
+        return None
+    return {k: friend.get(k) for k in FRIEND_MARKER_FIELDS}
+
+
+def imported_snapshot_entry(friend: dict) -> Optional[dict]:
+    """Snapshot fields for an imported friend, None if it isn't geocoded"""
+    if friend.get("city_lat") is None or friend.get("city_lng") is None:
+        return None
+    return {k: friend.get(k) for k in IMPORTED_MARKER_FIELDS}
+
+
+def snapshot_sources(snapshot: dict) -> Tuple[List[dict], List[dict]]:
+    """(friends, imported friends) stored in a snapshot"""
+    friends, imported = [], []
+    for key, entry in snapshot["markers"].items():
+        (friends if key.startswith("u:") else imported).append(entry)
+    return friends, imported
+
+
+async def build_map_snapshot_content(user_id: str) -> dict:
+    groups = await db.groups.find({"owner_id": user_id}, MAP_SNAPSHOT_GROUP_PROJECTION).to_list(100)
+    markers = {}
+    for friend in await load_friend_users(user_id):
+        entry = friend_snapshot_entry(friend)
+        if entry:
+            markers[f"u:{friend['user_id']}"] = entry
+    for friend in await find_located_imported_friends(user_id):
+        markers[f"i:{friend['friend_id']}"] = imported_snapshot_entry(friend)
+    return {"markers": markers, "groups": groups}
+
+
+async def get_map_snapshot(user_id: str) -> dict:
+    """The user's map snapshot, rebuilt first if it's missing, stale or too old.
+
+    `version` is None when a concurrent patch raced the rebuild: the returned
+    content is still current for this request but mustn't be cached by version.
+    """
+    now = datetime.now(timezone.utc)
+    snapshot = await db.map_snapshots.find_one({"user_id": user_id}, {"_id": 0})
+    if snapshot and not snapshot.get("stale") and as_utc(snapshot["built_at"]) > now - timedelta(seconds=MAP_SNAPSHOT_MAX_AGE):
+        if snapshot.get("oversized"):
+            return {**snapshot, **await build_map_snapshot_content(user_id)}
+        return snapshot
+
+    if snapshot is None:
+        # Create a placeholder before reading any data: patches that land while
+        # we build bump its version, which makes our conditional write below miss
+        try:
+            snapshot = await db.map_snapshots.find_one_and_update(
+                {"user_id": user_id},
+                {"$setOnInsert": {"user_id": user_id, "version": 0, "stale": True, "markers": {}, "groups": [], "built_at": now}},
+                upsert=True,
+                projection={"_id": 0, "version": 1},
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            snapshot = await db.map_snapshots.find_one({"user_id": user_id}, {"_id": 0, "version": 1})
+
+    content = await build_map_snapshot_content(user_id)
+    oversized = len(bson.encode(content)) > MAP_SNAPSHOT_MAX_BYTES
+    stored = {"markers": {}, "groups": []} if oversized else content
+    result = await db.map_snapshots.update_one(
+        {"user_id": user_id, "version": snapshot["version"]},
+        {"$set": {**stored, "oversized": oversized, "stale": False, "built_at": now}, "$inc": {"version": 1}}
+    )
+    return {
+        "user_id": user_id,
+        "version": snapshot["version"] + 1 if result.modified_count else None,
+        **content,
+        "stale": False,
+        "built_at": now
+    }
+
+
+async def patch_map_snapshots(user_ids: List[str], key: str, entry: Optional[dict]):
+    """Set (or remove, when entry is None) one marker source in the snapshots of `user_ids`"""
+    if not user_ids:
+        return
+    update = {"$inc": {"version": 1}}
+    if entry is None:
+        update["$unset"] = {f"markers.{key}": ""}
+    else:
+        update["$set"] = {f"markers.{key}": entry}
+    try:
+        await db.map_snapshots.update_many({"user_id": {"$in": user_ids}, "oversized": {"$ne": True}}, update)
+    except OperationFailure:
+        # The patch would push a snapshot past the document size limit: rebuild instead
+        await invalidate_map_snapshots(user_ids)
+        return
+    await db.map_snapshots.update_many({"user_id": {"$in": user_ids}, "oversized": True}, {"$inc": {"version": 1}})
+    await bump_data_versions(user_ids, "map")
+
+
+async def on_groups_changed(user_id: str):
+    """Refresh the groups stored in the owner's snapshot after any group write"""
+    groups = await db.groups.find({"owner_id": user_id}, MAP_SNAPSHOT_GROUP_PROJECTION).to_list(100)
+    await db.map_snapshots.update_one(
+        {"user_id": user_id},
+        {"$set": {"groups": groups}, "$inc": {"version": 1}}
+    )
+    await bump_data_versions([user_id], "map", "groups")
+
+
+async def invalidate_map_snapshots(user_ids: List[str]):
+    """Force a rebuild on next read, for bulk writes where patching isn't worth it"""
+    if not user_ids:
+        return
+    await db.map_snapshots.update_many(
+        {"user_id": {"$in": user_ids}},
+        {"$set": {"stale": True}, "$inc": {"version": 1}}
+    )
+    await bump_data_versions(user_ids, "map")
+
+
+# ============== MAP CLUSTERING ==============
+
+MAX_MERCATOR_LAT = 85.05112878
+
+
+def mercator_xy(lat: float, lng: float) -> Tuple[float, float]:
+    """Project to the unit Web Mercator square, (0, 0) being the top-left corner"""
+    lat = max(-MAX_MERCATOR_LAT, min(MAX_MERCATOR_LAT, lat))
+    sin_lat = math.sin(math.radians(lat))
+    x = (lng + 180) / 360
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return min(max(x, 0.0), 1.0 - 1e-12), min(max(y, 0.0), 1.0 - 1e-12)
+
+
+class MarkerClusterIndex:
+    """Grid hierarchy of marker clusters, one level per zoom, built once per marker set.
+
+    At zoom z the map is split into 2**z * (256 / radius) cells per axis, so each
+    cell is `radius` screen pixels wide. The finest level is built from the
+    markers and each coarser level by merging 2x2 child cells.
+    """
+
+    def __init__(self, markers: List[dict], max_zoom: int = MAP_CLUSTER_MAX_ZOOM, radius: int = MAP_CLUSTER_RADIUS):
+        self.markers = [m for m in markers if m.get("lat") is not None and m.get("lng") is not None]
+        self.max_zoom = max_zoom
+        self.base_cells = max(1, 256 // radius)
+        self.levels: List[Dict[Tuple[int, int], dict]] = [None] * (max_zoom + 1)
+
+        cells_per_axis = self.base_cells << max_zoom
+        finest = {}
+        for i, marker in enumerate(self.markers):
+            x, y = mercator_xy(marker["lat"], marker["lng"])
+            key = (int(x * cells_per_axis), int(y * cells_per_axis))
+            cell = finest.get(key)
+            if cell is None:
+                cell = finest[key] = {
+                    "count": 0, "sum_lat": 0.0, "sum_lng": 0.0, "first": i,
+                    "min_lat": marker["lat"], "max_lat": marker["lat"],
+                    "min_lng": marker["lng"], "max_lng": marker["lng"],
+                    "colors": {}, "types": {}
+                }
+            self._add_marker(cell, marker)
+        self.levels[max_zoom] = finest
+
+        for zoom in range(max_zoom - 1, -1, -1):
+            level = {}
+            for (cx, cy), child in self.levels[zoom + 1].items():
+                key = (cx >> 1, cy >> 1)
+                cell = level.get(key)
+                if cell is None:
+                    level[key] = {**child, "colors": dict(child["colors"]), "types": dict(child["types"])}
+                else:
+                    self._merge(cell, child)
+            self.levels[zoom] = level
+
+    @staticmethod
+    def _add_marker(cell: dict, marker: dict):
+        cell["count"] += 1
+        cell["sum_lat"] += marker["lat"]
+        cell["sum_lng"] += marker["lng"]
+        cell["min_lat"] = min(cell["min_lat"], marker["lat"])
+        cell["max_lat"] = max(cell["max_lat"], marker["lat"])
+        cell["min_lng"] = min(cell["min_lng"], marker["lng"])
+        cell["max_lng"] = max(cell["max_lng"], marker["lng"])
+        color = marker.get("marker_color") or "none"
+        cell["colors"][color] = cell["colors"].get(color, 0) + 1
+        marker_type = marker.get("marker_type", "unknown")
+        cell["types"][marker_type] = cell["types"].get(marker_type, 0) + 1
+
+    @staticmethod
+    def _merge(cell: dict, child: dict):
+        cell["count"] += child["count"]
+        cell["sum_lat"] += child["sum_lat"]
+        cell["sum_lng"] += child["sum_lng"]
+        cell["first"] = min(cell["first"], child["first"])
+        for bound, pick in (("min_lat", min), ("max_lat", max), ("min_lng", min), ("max_lng", max)):
+            cell[bound] = pick(cell[bound], child[bound])
+        for field in ("colors", "types"):
+            for k, v in child[field].items():
+                cell[field][k] = cell[field].get(k, 0) + v
+
+    def _viewport_cells(self, zoom: int, bbox: Tuple[float, float, float, float]) -> List[Tuple[Tuple[int, int], dict]]:
+        """Cells of a level whose grid square intersects the viewport"""
+        level = self.levels[zoom]
+        cells_per_axis = self.base_cells << zoom
+        min_lng, min_lat, max_lng, max_lat = bbox
+        left, bottom = mercator_xy(min_lat, min_lng)
+        right, top = mercator_xy(max_lat, max_lng)
+        x0, x1 = int(left * cells_per_axis), int(right * cells_per_axis)
+        y0, y1 = int(top * cells_per_axis), int(bottom * cells_per_axis)
+        # A box crossing the antimeridian covers the columns at both edges of the map
+        columns = list(range(x0, x1 + 1)) if min_lng <= max_lng else \
+            list(range(x0, cells_per_axis)) + list(range(0, x1 + 1))
+        if len(columns) * (y1 - y0 + 1) >= len(level):
+            return list(level.items())
+        return [
+            ((cx, cy), level[(cx, cy)])
+            for cx in columns for cy in range(y0, y1 + 1) if (cx, cy) in level
+        ]
+
+    def query(self, zoom: int, bbox: Optional[Tuple[float, float, float, float]] = None) -> List[dict]:
+        if zoom > self.max_zoom:
+            return [
+                {"type": "marker", **m} for m in self.markers
+                if bbox is None or point_in_bbox(m["lat"], m["lng"], bbox)
+            ]
+        zoom = max(zoom, 0)
+        cells = self.levels[zoom].items() if bbox is None else self._viewport_cells(zoom, bbox)
+        result = []
+        for (cx, cy), cell in cells:
+            if cell["count"] == 1:
+                marker = self.markers[cell["first"]]
+                if bbox is None or point_in_bbox(marker["lat"], marker["lng"], bbox):
+                    result.append({"type": "marker", **marker})
+                continue
+            # Keep a cluster if any of its markers may be visible, wherever its centroid falls
+            if bbox is not None and not bounds_in_bbox(
+                cell["min_lat"], cell["min_lng"], cell["max_lat"], cell["max_lng"], bbox
+            ):
+                continue
+            lat = cell["sum_lat"] / cell["count"]
+            lng = cell["sum_lng"] / cell["count"]
+            result.append({
+                "type": "cluster",
+                "cluster_id": f"{zoom}/{cx}/{cy}",
+                "count": cell["count"],
+                "lat": lat,
+                "lng": lng,
+                "bounds": [cell["min_lng"], cell["min_lat"], cell["max_lng"], cell["max_lat"]],
+                "groups": cell["colors"],
+                "marker_types": cell["types"]
             })
-    
-    # Add imported friends
-    imported = await db.imported_friends.find(
-        {"owner_id": user["user_id"], "city_lat": {"$ne": None}},
-        {"_id": 0}
-    ).to_list(1000)
-    
-    for friend in imported:
-        friend_groups = imported_groups.get(friend["friend_id"], [])
-        map_data.append({
-            "friend_id": friend["friend_id"],
-            "name": f"{friend['first_name']} {friend.get('last_name', '')}".strip(),
-            "city": friend["city"],
-            "lat": friend["city_lat"],
-            "lng": friend["city_lng"],
-            "email": friend.get("email"),
-            "phone": friend.get("phone"),
-            "photo": friend.get("photo"),
-            "geocode_status": friend.get("geocode_status", "success"),
-            "marker_type": "imported",
-            "groups": friend_groups,
-            "marker_color": friend_groups[0]["color"] if friend_groups else None
+        return result
+
+
+# user_id -> (snapshot version, MarkerClusterIndex over that snapshot's grouped markers)
+cluster_index_cache = TTLCache(1000)
+
+
+@app.get("/api/friends/map/clusters")
+async def get_friends_map_clusters(zoom: int, bbox: Optional[str] = None, user: dict = Depends(get_current_user)):
+    """Pre-aggregated map clusters for a zoom level, optionally limited to a viewport"""
+    viewport = parse_bbox(bbox) if bbox else None
+    cached = cluster_index_cache.get(user["user_id"])
+    index = None
+    if cached:
+        # Cheap version probe; the index is only rebuilt when the snapshot changed
+        current = await db.map_snapshots.find_one(
+            {"user_id": user["user_id"], "stale": False},
+            {"_id": 0, "version": 1, "built_at": 1}
+        )
+        if (current and current["version"] == cached[0]
+                and as_utc(current["built_at"]) > datetime.now(timezone.utc) - timedelta(seconds=MAP_SNAPSHOT_MAX_AGE)):
+            index = cached[1]
+    if index is None:
+        snapshot = await get_map_snapshot(user["user_id"])
+        index = MarkerClusterIndex(grouped_map_markers(*snapshot_sources(snapshot), snapshot["groups"]))
+        if snapshot["version"] is not None:
+            cluster_index_cache.set(user["user_id"], (snapshot["version"], index))
+    clusters = index.query(zoom, viewport)
+    return {"zoom": zoom, "total": len(index.markers), "clusters": clusters}
+
+
+# ============== LIFECYCLE ==============
+
+# (collection, keys, options) for every index the hot paths rely on
+INDEXES = [
+    ("users", [("user_id", 1)], {"unique": True}),
+    ("friendships", [("pair_key", 1)], {"unique": True}),
+    ("friendships", [("friendship_id", 1)], {"unique": True}),
+    ("friendships", [("user_ids", 1), ("status", 1)], {}),
+    ("friendships", [("friend_id", 1), ("status", 1)], {}),
+    ("friend_edges", [("owner_id", 1), ("friend_id", 1)], {"unique": True}),
+    ("imported_friends", [("owner_id", 1), ("created_at", 1), ("friend_id", 1)], {}),
+    ("imported_friends", [("owner_id", 1), ("location", "2dsphere")], {}),
+    ("imported_friends", [("friend_id", 1)], {"unique": True}),
+    ("imported_friends", [("owner_id", 1), ("fingerprint", 1)], {}),
+    ("imported_friends", [("owner_id", 1), ("block_keys", 1)], {}),
+    ("import_jobs", [("job_id", 1)], {"unique": True}),
+    ("import_jobs", [("status", 1), ("created_at", 1)], {}),
+    ("import_jobs", [("owner_id", 1), ("created_at", 1)], {}),
+    ("import_job_rows", [("job_id", 1), ("index", 1)], {"unique": True}),
+    ("import_job_rows", [("job_id", 1), ("status", 1), ("index", 1)], {}),
+    ("import_job_rows", [("job_id", 1), ("data.city", 1), ("status", 1)], {}),
+    ("import_job_rows", [("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ("users", [("active_location", "2dsphere")], {}),
+    ("users", [("competent_locations", "2dsphere")], {}),
+    ("meetups", [("location", "2dsphere")], {}),
+    ("map_snapshots", [("user_id", 1)], {"unique": True}),
+    ("messages", [("conversation_id", 1), ("created_at", 1), ("message_id", 1)], {}),
+    ("messages", [("to_user_id", 1), ("created_at", 1), ("message_id", 1)], {}),
+    ("messages", [("from_user_id", 1), ("created_at", 1), ("message_id", 1)], {}),
+    ("conversations", [("conversation_id", 1)], {"unique": True}),
+    ("user_search_index", [("user_id", 1)], {"unique": True}),
+    ("user_search_index", [("grams", 1)], {}),
+    ("user_search_index", [("name", 1)], {}),
+    ("user_search_index", [("email", 1)], {}),
+    ("user_search_index", [("name_tokens", 1)], {}),
+    ("user_search_index", [("email_tokens", 1)], {}),
+    ("geocode_cache", [("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ("conversations", [("user_ids", 1), ("last_message_at", 1), ("conversation_id", 1)], {}),
+]
+
+
+async def ensure_indexes():
+    """Create missing indexes (no-op when they already exist); a unique index that can't be built fails startup"""
+    missing_unique = []
+    for collection, keys, options in INDEXES:
+        try:
+            await db[collection].create_index(keys, **options)
+        except Exception as e:
+            if options.get("unique"):
+                missing_unique.append(f"{keys} on {collection}: {e}")
+            else:
+                print(f"WARNING: could not create index {keys} on {collection}: {e}")
+    # Request paths rely on unique indexes to reject duplicates (friendships.pair_key,
+    # imported friend_id, ...): serving without them would silently allow duplicates
+    if missing_unique:
+        raise RuntimeError(f"Could not create unique indexes: {'; '.join(missing_unique)}")
+
+
+async def dedupe_users():
+    """Collapse users duplicated by the old first-login insert race, keeping the oldest document"""
+    async for row in db.users.aggregate([
+        {"$group": {"_id": "$user_id", "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ]):
+        duplicates = await db.users.find({"user_id": row["_id"]}, {"_id": 1}).sort(
+            [("created_at", 1), ("_id", 1)]
+        ).to_list(None)
+        await db.users.delete_many({"_id": {"$in": [user["_id"] for user in duplicates[1:]]}})
+
+
+async def migrate_friendship_pair_keys():
+    """Backfill pair_key/user_ids, dropping duplicate pairs so the unique index can build"""
+    async for friendship in db.friendships.find({"pair_key": {"$exists": False}}):
+        pair_key = friendship_pair_key(friendship["user_id"], friendship["friend_id"])
+        existing = await db.friendships.find_one({"pair_key": pair_key}, {"_id": 1, "status": 1})
+        if existing:
+            # Keep one document per pair, preferring an accepted friendship
+            if existing["status"] == "accepted" or friendship["status"] != "accepted":
+                await db.friendships.delete_one({"_id": friendship["_id"]})
+                continue
+            await db.friendships.delete_one({"_id": existing["_id"]})
+        await db.friendships.update_one(
+            {"_id": friendship["_id"]},
+            {"$set": {
+                "pair_key": pair_key,
+                "user_ids": sorted((friendship["user_id"], friendship["friend_id"]))
+            }}
+        )
+
+
+async def backfill_friend_edges():
+    """Build adjacency edges for every accepted friendship"""
+    async for friendship in db.friendships.find({"status": "accepted"}, {"user_id": 1, "friend_id": 1}):
+        await add_friend_edges(friendship["user_id"], friendship["friend_id"])
+
+
+async def backfill_geo_points():
+    """Add GeoJSON copies of existing coordinates for the 2dsphere indexes"""
+    async for friend in db.imported_friends.find(
+        {"location": {"$exists": False}, "city_lat": {"$ne": None}, "city_lng": {"$ne": None}},
+        {"city_lat": 1, "city_lng": 1}
+    ):
+        await db.imported_friends.update_one(
+            {"_id": friend["_id"]},
+            {"$set": {"location": geo_point(friend["city_lat"], friend["city_lng"])}}
+        )
+    async for user in db.users.find({}, {"active_city_lat": 1, "active_city_lng": 1, "competent_cities": 1}):
+        update = geo_update(user_geo_fields(user))
+        if update:
+            await db.users.update_one({"_id": user["_id"]}, update)
+    async for meetup in db.meetups.find({"location": {"$exists": False}}, {"city_lat": 1, "city_lng": 1}):
+        location = geo_point(meetup.get("city_lat"), meetup.get("city_lng"))
+        if location:
+            await db.meetups.update_one({"_id": meetup["_id"]}, {"$set": {"location": location}})
+
+
+async def backfill_conversations():
+    """Assign conversation ids to existing messages and rebuild the conversation summaries"""
+    async for message in db.messages.find({"conversation_id": {"$exists": False}}, {"from_user_id": 1, "to_user_id": 1}):
+        await db.messages.update_one(
+            {"_id": message["_id"]},
+            {"$set": {"conversation_id": conversation_id_for(message["from_user_id"], message["to_user_id"])}}
+        )
+    summaries = {}
+    async for message in db.messages.find({}, {"_id": 0}).sort("created_at", 1):
+        summary = summaries.setdefault(message["conversation_id"], {
+            "user_ids": sorted({message["from_user_id"], message["to_user_id"]}),
+            "created_at": message["created_at"],
+            "unread": {}
         })
-    
-    return map_data
+        summary["last_message"] = message_summary(message)
+        summary["last_message_at"] = message["created_at"]
+        if not message.get("read"):
+            summary["unread"][message["to_user_id"]] = summary["unread"].get(message["to_user_id"], 0) + 1
+    for conversation_id, summary in summaries.items():
+        await db.conversations.update_one({"conversation_id": conversation_id}, {"$set": summary}, upsert=True)
+
+
+async def backfill_unread_counters():
+    """Seed the per-user unread totals from the unread messages"""
+    async for row in db.messages.aggregate([
+        {"$match": {"read": False}},
+        {"$group": {"_id": "$to_user_id", "total": {"$sum": 1}}}
+    ]):
+        await db.unread_counters.update_one({"_id": row["_id"]}, {"$set": {"total": row["total"]}}, upsert=True)
+
+
+async def backfill_user_search_index():
+    """Index every existing user for search"""
+    async for user in db.users.find({}, {"_id": 0, "user_id": 1, "name": 1, "email": 1}):
+        await index_user_for_search(user)
+
+
+async def backfill_imported_friend_fingerprints():
+    """Store fingerprint and block_keys on imported friends created before duplicate detection"""
+    async for friend in db.imported_friends.find(
+        {"fingerprint": {"$exists": False}},
+        {"_id": 0, "friend_id": 1, "first_name": 1, "last_name": 1, "city": 1, "email": 1, "phone": 1}
+    ):
+        await db.imported_friends.update_one(
+            {"friend_id": friend["friend_id"]},
+            {"$set": friend_dedup_fields(friend)}
+        )
+
+
+# Applied once each, in order, and recorded in the `migrations` collection.
+# Every migration must be idempotent: several workers may start at once.
+MIGRATIONS = [
+    ("users_dedupe", dedupe_users),
+    ("friendship_pair_keys", migrate_friendship_pair_keys),
+    ("friend_edges_backfill", backfill_friend_edges),
+    ("geo_points_backfill", backfill_geo_points),
+    ("conversations_backfill", backfill_conversations),
+    ("unread_counters_backfill", backfill_unread_counters),
+    ("user_search_index_backfill", backfill_user_search_index),
+    ("imported_friend_fingerprints_backfill", backfill_imported_friend_fingerprints),
+]
+
+
+async def run_migrations():
+    for name, migration in MIGRATIONS:
+        try:
+            if await db.migrations.find_one({"_id": name}):
+                continue
+            await migration()
+            await db.migrations.update_one(
+                {"_id": name},
+                {"$set": {"applied_at": datetime.now(timezone.utc)}},
+                upsert=True
+            )
+            print(f"Applied migration {name}")
+        except Exception as e:
+            print(f"WARNING: migration {name} failed: {e}")
+
+
+@app.on_event("startup")
+async def startup():
+    # Migrations first: they make existing data satisfy the unique indexes
+    await run_migrations()
+    await ensure_indexes()
+    get_http_client()
+    await load_gazetteer()
+    await import_workers.start()
+    if jwks_key_set is not None:
+        await jwks_key_set.start()
+    await event_broker.start(event_hub.deliver)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if jwks_key_set is not None:
+        await jwks_key_set.stop()
+    await event_broker.stop()
+    await import_workers.stop()
+    await geocode_scheduler.stop()
+    if gazetteer is not None:
+        gazetteer.close()
+    if http_client is not None:
+        await http_client.aclose()
 
 
 # ============== HEALTH CHECK ==============
@@ -961,6 +4216,23 @@ async def get_friends_for_map_with_groups(user: dict = Depends(get_current_user)
 async def health():
     return {"status": "healthy", "timestamp": datetime.now(timezone.utc).isoformat()}
 
+@app.get("/api/metrics")
+async def metrics():
+    """In-process cache counters"""
+    return {
+        "token_cache": verified_token_cache.stats(),
+        "user_cache": user_cache.stats(),
+        "events": event_hub.stats(),
+        "geocode_cache": geocode_memory_cache.stats(),
+        "geocode_scheduler": geocode_scheduler.stats(),
+        "gazetteer": gazetteer.stats() if gazetteer is not None else None,
+        "import_workers": import_workers.stats(),
+        "jwks": {
+            "keys": len(jwks_key_set.keys),
+            "last_refresh": jwks_key_set.last_refresh.isoformat() if jwks_key_set.last_refresh else None
+        } if jwks_key_set is not None else None
+    }
+
 # ============== STATIC FILES (Production) ==============
 
 # Ensure the static directory exists or handle it gracefully
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# server.py only needs a URL at import time; these tests never reach the database
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,26 @@
+import pytest
+from pydantic import ValidationError
+
+from server import ImportedFriendUpdate, MeetupCreate, UserUpdate
+
+
+def test_coordinates_within_range():
+    assert UserUpdate(active_city_lat=-90, active_city_lng=180).active_city_lat == -90
+    assert ImportedFriendUpdate(city_lat=45.5, city_lng=-179.9).city_lng == -179.9
+    assert UserUpdate(competent_cities=[{"name": "Milano", "lat": 45.46, "lng": 9.19}, {"name": "Roma"}])
+
+
+@pytest.mark.parametrize("fields", [
+    {"active_city_lat": 90.1},
+    {"active_city_lng": -180.5},
+    {"competent_cities": [{"name": "X", "lat": 45, "lng": 181}]},
+    {"competent_cities": [{"name": "X", "lat": "45", "lng": 9}]},
+])
+def test_user_coordinates_out_of_range(fields):
+    with pytest.raises(ValidationError):
+        UserUpdate(**fields)
+
+
+def test_meetup_coordinates_out_of_range():
+    with pytest.raises(ValidationError):
+        MeetupCreate(title="t", city="c", city_lat=91, city_lng=0, date="2026-01-01")
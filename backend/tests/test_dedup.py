@@ -0,0 +1,51 @@
+from server import friend_dedup_fields, likely_duplicates
+
+
+def friend(first_name, last_name="", city="", email=None, phone=None, **fields):
+    data = {"first_name": first_name, "last_name": last_name, "city": city, "email": email, "phone": phone, **fields}
+    return {**data, **friend_dedup_fields(data)}
+
+
+def test_fingerprint_normalizes_fields():
+    a = friend("Mario", "Bianchi", "Roma", "m@x.it", "+39 333 1234567")
+    b = friend("mario", "BIANCHI", "ROMA ", "M@x.it", "333 1234567")
+    assert a["fingerprint"] == b["fingerprint"]
+    assert friend("Élodie", "Rossi", "Forlì")["fingerprint"] == friend("Elodie", "Rossi", "Forli")["fingerprint"]
+
+
+def test_fingerprint_differs_on_any_field():
+    base = friend("Mario", "Bianchi", "Roma", "m@x.it")
+    assert base["fingerprint"] != friend("Mario", "Bianchi", "Milano", "m@x.it")["fingerprint"]
+    assert base["fingerprint"] != friend("Mario", "Bianchi", "Roma", "other@x.it")["fingerprint"]
+
+
+def test_block_keys():
+    assert friend("Giovanni", "Rossi", email="G@x.it", phone="+39 333 1234567")["block_keys"] == [
+        "e:g@x.it", "n:giovanni:r", "n:rossi:g", "p:331234567"
+    ]
+    # A bare initial is no surname, and a single name has no name block
+    assert friend("G.", "Rossi")["block_keys"] == ["n:rossi:g"]
+    assert friend("Mario")["block_keys"] == []
+
+
+def test_initial_matches_full_first_name():
+    a = friend("Giovanni", "Rossi", "Milano", city_lat=45.46, city_lng=9.19)
+    b = friend("G.", "Rossi", "Milan", city_lat=45.47, city_lng=9.18)
+    assert set(a["block_keys"]) & set(b["block_keys"])
+    assert likely_duplicates(a, b)
+
+
+def test_swapped_name_columns():
+    assert likely_duplicates(friend("Giovanni", "Rossi", "Roma"), friend("Rossi", "Giovanni", "Roma"))
+
+
+def test_different_people_sharing_a_block():
+    assert not likely_duplicates(friend("Giovanni", "Rossi", "Roma"), friend("Giulia", "Rossi", "Roma"))
+    a = friend("Giovanni", "Rossi", "Roma", city_lat=41.9, city_lng=12.5)
+    b = friend("Giovanni", "Rossi", "Torino", city_lat=45.07, city_lng=7.69)
+    assert not likely_duplicates(a, b)
+
+
+def test_shared_contact_is_enough():
+    assert likely_duplicates(friend("Marco", "Neri", "Roma", email="luca@x.it"), friend("Luca", "Verdi", "Bari", email="LUCA@x.it"))
+    assert likely_duplicates(friend("Marco", "Neri", phone="0039 333 1234567"), friend("M", "N", phone="333-1234567"))
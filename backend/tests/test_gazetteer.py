@@ -0,0 +1,54 @@
+import pytest
+
+import server
+from server import Gazetteer
+
+ROWS = [
+    ("3173435", "Milano", "Milan,Mailand,Milán", "45.46427", "9.18951", "IT", "1371498"),
+    ("3169070", "Roma", "Rome,Rom", "41.89193", "12.51133", "IT", "2318895"),
+    ("4219762", "Rome", "", "34.25704", "-85.16467", "US", "36303"),
+    ("3176959", "Firenze", "Florence,Florenz", "43.77925", "11.24626", "IT", "382258"),
+]
+
+
+@pytest.fixture
+def gazetteer(tmp_path):
+    source = tmp_path / "cities.txt"
+    source.write_text("".join(
+        f"{geonameid}\t{name}\t{name}\t{aliases}\t{lat}\t{lng}\tP\tPPL\t{country}\t\t\t\t\t\t{population}\t\t\tEurope/Rome\t2024-01-01\n"
+        for geonameid, name, aliases, lat, lng, country, population in ROWS
+    ), encoding="utf-8")
+    index = Gazetteer.open(str(source), str(tmp_path / "cities.txt.idx"))
+    yield index
+    index.close()
+
+
+def lookup_name(gazetteer, query, fuzzy=False):
+    place = gazetteer.lookup(server.geocode_cache_key(query), fuzzy)
+    return place and place["display_name"]
+
+
+def test_exact_alias_prefers_population(gazetteer):
+    assert lookup_name(gazetteer, "Rome").startswith("Roma")
+    assert lookup_name(gazetteer, "MILÁN").startswith("Milano")
+
+
+def test_country_suffix(gazetteer):
+    assert lookup_name(gazetteer, "Rome, US").startswith("Rome")
+    assert lookup_name(gazetteer, "Rome, Lazio") is None
+
+
+def test_fuzzy_only_when_asked(gazetteer):
+    assert lookup_name(gazetteer, "Firenzee") is None
+    assert lookup_name(gazetteer, "Firenzee", fuzzy=True).startswith("Firenze")
+
+
+def test_fuzzy_rejects_loose_matches(gazetteer):
+    assert lookup_name(gazetteer, "Romania", fuzzy=True) is None
+    assert lookup_name(gazetteer, "Roma Nord", fuzzy=True) is None
+
+
+def test_common_trigrams_are_skipped(gazetteer, monkeypatch):
+    monkeypatch.setattr(server, "GAZETTEER_MAX_POSTINGS", 0)
+    assert lookup_name(gazetteer, "Firenzee", fuzzy=True) is None
+    assert lookup_name(gazetteer, "Firenze").startswith("Firenze")
@@ -0,0 +1,105 @@
+import asyncio
+import csv
+import io
+
+import pytest
+
+import server
+from server import csv_record_open, csv_rows, decode_chunks, detect_encoding, text_lines, vcard_rows
+
+
+async def byte_chunks(data: bytes, size: int = 7):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+def parse(data: bytes, rows=csv_rows, **kwargs):
+    async def collect():
+        return [item async for item in rows(text_lines(decode_chunks(byte_chunks(data))), **kwargs)]
+    return asyncio.run(collect())
+
+
+def test_stray_quote_in_unquoted_field():
+    data = 'Nome,Cognome,Città\nMario,O"Brien,Milano\nLuigi,Verdi,Roma\nAnna,X,Torino\n'
+    rows = parse(data.encode())
+    assert [row for row, error in rows] == list(csv.DictReader(io.StringIO(data)))
+    assert all(error is None for _, error in rows)
+
+
+def test_multiline_quoted_field():
+    rows = parse('Nome,Note,Città\nMario,"prima riga\nseconda ""riga""",Milano\nLuigi,,Roma\n'.encode())
+    assert rows == [
+        ({"Nome": "Mario", "Note": 'prima riga\nseconda "riga"', "Città": "Milano"}, None),
+        ({"Nome": "Luigi", "Note": "", "Città": "Roma"}, None),
+    ]
+
+
+def test_unterminated_quote_at_eof_becomes_failed_row():
+    rows = parse('Nome,Città\nLuigi,Roma\nMario,"Milano\n'.encode())
+    assert rows == [
+        ({"Nome": "Luigi", "Città": "Roma"}, None),
+        ({"record": 'Mario,"Milano'}, "Unterminated quoted field"),
+    ]
+
+
+def test_unterminated_quote_is_capped(monkeypatch):
+    monkeypatch.setattr(server, "IMPORT_MAX_RECORD_LINES", 3)
+    data = "Nome,Città\n" + 'Mario,"Milano\n' + "".join(f"N{i},Roma\n" for i in range(5))
+    rows = parse(data.encode())
+    assert rows[0] == ({"record": 'Mario,"Milano'}, "Unterminated quoted field")
+    assert [row["Nome"] for row, _ in rows[1:]] == [f"N{i}" for i in range(5)]
+
+
+def test_header_column_skips_preamble():
+    data = 'Notes:\n"When exporting, some emails\nmay be missing"\n\nFirst Name,Last Name\nLuca,Verdi\n'
+    assert parse(data.encode(), header_column="First Name") == [({"First Name": "Luca", "Last Name": "Verdi"}, None)]
+
+
+def test_csv_record_open():
+    assert not csv_record_open('a,O"Brien,c')
+    assert not csv_record_open('a,"b ""c""",d')
+    assert csv_record_open('a,"b\nc')
+    assert csv_record_open('a,"b""')
+    assert not csv_record_open('a,"b"')
+
+
+@pytest.mark.parametrize("encoding,expected", [
+    ("utf-8", "utf-8"),
+    ("utf-8-sig", "utf-8-sig"),
+    ("utf-16", "utf-16"),
+    ("cp1252", "cp1252"),
+])
+def test_detect_encoding(encoding, expected):
+    assert detect_encoding("Città,Forlì,€\n".encode(encoding)) == expected
+
+
+def test_detect_encoding_ignores_truncated_utf8_sample():
+    assert detect_encoding("Forlì".encode("utf-8")[:-1]) == "utf-8"
+
+
+def test_non_utf8_rows_decode():
+    rows = parse("Nome,Città\nJosé,Forlì\n".encode("cp1252"))
+    assert rows == [({"Nome": "José", "Città": "Forlì"}, None)]
+
+
+def test_vcard_rows():
+    data = (
+        "BEGIN:VCARD\r\nN:Rossi;Mario;;;\r\nitem1.EMAIL;TYPE=INTERNET:mario@x.it\r\n"
+        "TEL;TYPE=cell:+39 333\r\nADR;TYPE=home:;;Via Roma 1;Mil\r\n ano;;;IT\r\nEND:VCARD\r\n"
+        "BEGIN:VCARD\r\nFN:Anna Maria Bianchi\r\nADR:;;;Torino;;;\r\nEND:VCARD\r\n"
+    )
+    rows = parse(data.encode(), rows=vcard_rows)
+    assert rows == [
+        ({"Last Name": "Rossi", "First Name": "Mario", "Email": "mario@x.it", "Phone": "+39 333", "City": "Milano"}, None),
+        ({"City": "Torino", "First Name": "Anna", "Last Name": "Maria Bianchi"}, None),
+    ]
+
+
+def test_linkedin_connection_without_city():
+    row = {"First Name": "Anna", "Last Name": "Neri", "URL": "https://www.linkedin.com/in/anna",
+           "Email Address": "anna@x.it", "Company": "ACME", "Position": "CTO", "Connected On": "01 Jan 2024"}
+    assert server.import_row_fields(row) is None
+    assert server.import_row_fields(row, require_city=False) == {
+        "first_name": "Anna", "last_name": "Neri", "city": "", "email": "anna@x.it", "phone": None
+    }
+    assert server.import_row_fields({"Last Name": "Neri"}, require_city=False) is None
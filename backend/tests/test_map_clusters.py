@@ -0,0 +1,45 @@
+from server import MarkerClusterIndex, bounds_in_bbox
+
+
+def marker(lat, lng, **fields):
+    return {"lat": lat, "lng": lng, "marker_type": "imported", **fields}
+
+
+def test_cluster_kept_when_centroid_outside_viewport():
+    index = MarkerClusterIndex([marker(45, 9), marker(45, 9.4), marker(45, 9.5)])
+    result = index.query(5, (8.9, 44.9, 9.1, 45.1))
+    assert len(result) == 1
+    assert result[0]["type"] == "cluster"
+    assert result[0]["count"] == 3
+
+
+def test_viewport_drops_distant_cells():
+    index = MarkerClusterIndex([marker(45, 9), marker(45.1, 9.1), marker(-33.9, 151.2)])
+    result = index.query(1, (8.0, 44.0, 10.0, 46.0))
+    assert [item["count"] for item in result if item["type"] == "cluster"] == [2]
+    assert not [item for item in result if item["type"] == "marker"]
+
+
+def test_single_markers_filtered_by_position():
+    index = MarkerClusterIndex([marker(45, 9, name="in"), marker(41.9, 12.5, name="out")])
+    result = index.query(10, (8.0, 44.0, 10.0, 46.0))
+    assert [item["name"] for item in result] == ["in"]
+
+
+def test_viewport_across_antimeridian():
+    index = MarkerClusterIndex([marker(-17.7, 178.4, name="fiji"), marker(-14.3, -170.7, name="samoa"), marker(45, 9)])
+    result = index.query(3, (170.0, -30.0, -160.0, 0.0))
+    assert sorted(item.get("name") or item["type"] for item in result) in (["fiji", "samoa"], ["cluster"])
+    assert sum(item.get("count", 1) for item in result) == 2
+
+
+def test_no_viewport_returns_every_cell():
+    index = MarkerClusterIndex([marker(45, 9), marker(45, 9.001), marker(-33.9, 151.2)])
+    assert sum(item.get("count", 1) for item in index.query(0)) == 3
+
+
+def test_bounds_in_bbox():
+    assert bounds_in_bbox(44.0, 9.0, 46.0, 10.0, (9.5, 45.0, 11.0, 47.0))
+    assert not bounds_in_bbox(44.0, 9.0, 46.0, 10.0, (10.5, 45.0, 11.0, 47.0))
+    assert bounds_in_bbox(-20.0, 178.0, -10.0, 179.0, (170.0, -30.0, -160.0, 0.0))
+    assert not bounds_in_bbox(-20.0, 0.0, -10.0, 1.0, (170.0, -30.0, -160.0, 0.0))
@@ -0,0 +1,45 @@
+import asyncio
+
+from server import SingleFlight
+
+
+def test_concurrent_calls_share_one_task():
+    calls = []
+
+    async def load():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 42
+
+    async def run():
+        flight = SingleFlight()
+        return await asyncio.gather(flight.do("k", load), flight.do("k", load))
+
+    assert asyncio.run(run()) == [42, 42]
+    assert calls == [1]
+
+
+def test_call_survives_until_last_waiter_leaves():
+    finished = []
+
+    async def load():
+        await asyncio.sleep(0.05)
+        finished.append(1)
+        return 42
+
+    async def run():
+        flight = SingleFlight()
+        first = asyncio.ensure_future(flight.do("k", load))
+        second = asyncio.ensure_future(flight.do("k", load))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        assert await second == 42
+
+        abandoned = asyncio.ensure_future(flight.do("other", load))
+        await asyncio.sleep(0.01)
+        abandoned.cancel()
+        await asyncio.sleep(0.1)
+        return flight.in_flight("other")
+
+    assert asyncio.run(run()) is False
+    assert finished == [1]
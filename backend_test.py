@@ -1,5 +1,6 @@
 import requests
 import sys
+import time
 from datetime import datetime
 
 class MapYourFriendsAPITester:
@@ -139,7 +140,7 @@ class MapYourFriendsAPITester:
         return self.run_test("Geocode Single City", "POST", "api/geocode", 200, geocode_data)
 
     def test_csv_import(self):
-        """Test CSV import functionality"""
+        """Test CSV import functionality (queued job, polled until it finishes)"""
         # Create a simple CSV content for testing
         csv_content = "Nome,Cognome,Città\nTest,User,Milano\nAnother,Friend,Roma"
         
@@ -157,30 +158,47 @@ class MapYourFriendsAPITester:
         try:
             response = requests.post(url, headers=headers, files=files, timeout=15)
             
-            success = response.status_code == 200
-            if success:
-                self.tests_passed += 1
-                print(f"✅ Passed - Status: {response.status_code}")
-                try:
-                    response_data = response.json()
-                    print(f"   Response: {str(response_data)[:200]}...")
-                    # Store first imported friend ID for later tests
-                    if response_data.get('imported') and len(response_data['imported']) > 0:
-                        self.imported_friend_id = response_data['imported'][0].get('friend_id')
-                except:
-                    print(f"   Response: {response.text[:200]}...")
-            else:
-                print(f"❌ Failed - Expected 200, got {response.status_code}")
+            if response.status_code != 202:
+                print(f"❌ Failed - Expected 202, got {response.status_code}")
                 print(f"   Response: {response.text[:300]}")
                 self.failed_tests.append({
                     'test': 'CSV Import',
                     'endpoint': 'api/imported-friends/csv',
-                    'expected': 200,
+                    'expected': 202,
                     'actual': response.status_code,
                     'response': response.text[:300]
                 })
+                return False, {}
 
-            return success, response.json() if success and response.text else {}
+            job_id = response.json().get('job_id')
+            print(f"   Queued job {job_id}, polling...")
+            job = {}
+            for _ in range(60):
+                time.sleep(1)
+                job_response = requests.get(f"{url.rsplit('/', 1)[0]}/import-jobs/{job_id}", headers=headers, timeout=10)
+                job = job_response.json() if job_response.status_code == 200 else {}
+                if job.get('status') in ('completed', 'failed'):
+                    break
+
+            success = job.get('status') == 'completed'
+            if success:
+                self.tests_passed += 1
+                print(f"✅ Passed - Job completed")
+                print(f"   Response: {str(job)[:200]}...")
+                # Store first imported friend ID for later tests
+                if job.get('imported'):
+                    self.imported_friend_id = job['imported'][0].get('friend_id')
+            else:
+                print(f"❌ Failed - Job ended as {job.get('status')}")
+                self.failed_tests.append({
+                    'test': 'CSV Import',
+                    'endpoint': f'api/imported-friends/import-jobs/{job_id}',
+                    'expected': 'completed',
+                    'actual': job.get('status'),
+                    'response': str(job)[:300]
+                })
+
+            return success, job
 
         except Exception as e:
             print(f"❌ Failed - Error: {str(e)}")
@@ -144,25 +144,19 @@ def extract_country_from_city(display_name: str) -> str:
 async def calculate_stats_for_user(db, user_id: str) -> dict:
     """Calcola tutte le statistiche per un utente."""
     
-    # Conta amici registrati (friendships accettate)
-    friendships = await db.friendships.find({
-        "$or": [{"user_id": user_id}, {"friend_id": user_id}],
-        "status": "accepted"
-    }).to_list(1000)
-    total_registered = len(friendships)
+    # Conta amici registrati (archi di adiacenza delle friendships accettate)
+    edges = await db.friend_edges.find(
+        {"owner_id": user_id},
+        {"_id": 0, "friend_id": 1}
+    ).to_list(None)
+    friend_ids = [e["friend_id"] for e in edges]
+    total_registered = len(friend_ids)
     
     # Prendi info degli amici registrati
-    friend_ids = []
-    for f in friendships:
-        if f["user_id"] == user_id:
-            friend_ids.append(f["friend_id"])
-        else:
-            friend_ids.append(f["user_id"])
-    
     registered_friends = await db.users.find(
         {"user_id": {"$in": friend_ids}},
         {"active_city": 1, "active_city_lat": 1, "active_city_lng": 1}
-    ).to_list(1000)
+    ).to_list(None)
     
     # Conta amici importati
     imported_friends = await db.imported_friends.find(
@@ -82,19 +82,16 @@ async def export_user_data(user_id: str, output_dir: str = None) -> str:
         print(f"   - {len(imported_friends)} imported friends")
         
         # 3. Registered friends (public info only)
-        friendships = await db.friendships.find({
-            "$or": [{"user_id": user_id}, {"friend_id": user_id}],
-            "status": "accepted"
-        }).to_list(1000)
-        
-        friend_ids = []
-        for f in friendships:
-            friend_ids.append(f["friend_id"] if f["user_id"] == user_id else f["user_id"])
+        edges = await db.friend_edges.find(
+            {"owner_id": user_id},
+            {"_id": 0, "friend_id": 1}
+        ).to_list(None)
+        friend_ids = [e["friend_id"] for e in edges]
         
         registered_friends = await db.users.find(
             {"user_id": {"$in": friend_ids}},
             {"_id": 0, "email": 0}  # Exclude private info
-        ).to_list(1000)
+        ).to_list(None)
         print(f"   - {len(registered_friends)} registered friends")
         
         # 4. Groups
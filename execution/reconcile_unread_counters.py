@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Script: reconcile_unread_counters.py
+
+Ricalcola i contatori dei messaggi non letti (conversations.unread.<user_id>
+e unread_counters.total) a partire dai messaggi stessi e corregge quelli
+che non corrispondono.
+Può essere eseguito come one-shot o schedulato come cron.
+"""
+
+import asyncio
+from collections import defaultdict
+from motor.motor_asyncio import AsyncIOMotorClient
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Configurazione
+MONGO_URL = os.environ.get("MONGO_URL")
+DB_NAME = os.environ.get("DB_NAME", "map_your_friends")
+
+
+async def count_unread(db, user_ids: list = None) -> dict:
+    """Conta i messaggi non letti per (destinatario, conversazione)."""
+    match = {"read": False}
+    if user_ids:
+        match["to_user_id"] = {"$in": user_ids}
+    counts = defaultdict(dict)
+    async for row in db.messages.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": {"user_id": "$to_user_id", "conversation_id": "$conversation_id"},
+            "count": {"$sum": 1}
+        }}
+    ]):
+        counts[row["_id"]["conversation_id"]][row["_id"]["user_id"]] = row["count"]
+    return counts
+
+
+async def reconcile(db, user_ids: list = None) -> dict:
+    """Allinea i contatori per conversazione e i totali per utente."""
+    counts = await count_unread(db, user_ids)
+    totals = defaultdict(int)
+    for per_user in counts.values():
+        for uid, count in per_user.items():
+            totals[uid] += count
+    fixed_conversations = 0
+
+    query = {"user_ids": {"$in": user_ids}} if user_ids else {}
+    async for conversation in db.conversations.find(query, {"conversation_id": 1, "user_ids": 1, "unread": 1}):
+        expected = counts.get(conversation["conversation_id"], {})
+        current = conversation.get("unread") or {}
+        fixes = {}
+        for uid in conversation["user_ids"]:
+            if user_ids and uid not in user_ids:
+                continue
+            if current.get(uid, 0) != expected.get(uid, 0):
+                fixes[f"unread.{uid}"] = expected.get(uid, 0)
+        if fixes:
+            await db.conversations.update_one({"_id": conversation["_id"]}, {"$set": fixes})
+            fixed_conversations += 1
+
+    fixed_users = 0
+    counter_query = {"_id": {"$in": user_ids}} if user_ids else {}
+    current_totals = {
+        doc["_id"]: doc.get("total", 0)
+        async for doc in db.unread_counters.find(counter_query)
+    }
+    for uid in set(current_totals) | set(totals):
+        if current_totals.get(uid, 0) != totals.get(uid, 0):
+            await db.unread_counters.update_one(
+                {"_id": uid},
+                {"$set": {"total": totals.get(uid, 0)}},
+                upsert=True
+            )
+            fixed_users += 1
+
+    return {"conversations": fixed_conversations, "users": fixed_users}
+
+
+async def main(user_ids: list = None):
+    client = AsyncIOMotorClient(MONGO_URL)
+    db = client[DB_NAME]
+
+    try:
+        result = await reconcile(db, user_ids)
+        print(f"✅ Contatori corretti: {result['conversations']} conversazioni, {result['users']} utenti")
+        return result
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--all":
+        asyncio.run(main())
+    elif len(sys.argv) > 1:
+        asyncio.run(main(sys.argv[1:]))
+    else:
+        print("Usage:")
+        print("  python reconcile_unread_counters.py <user_id> [<user_id> ...]   # Utenti specifici")
+        print("  python reconcile_unread_counters.py --all                       # Tutti gli utenti")
@@ -4,18 +4,22 @@ import { FileSpreadsheet, Upload, RefreshCw, Check, MapPin, AlertCircle, X } fro
 import { toast } from 'sonner';
 
 const API_URL = process.env.REACT_APP_BACKEND_URL;
+const POLL_INTERVAL_MS = 1500;
+
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
 
 export default function ImportModal({ onClose, onImported }) {
   const [uploading, setUploading] = useState(false);
   const [results, setResults] = useState(null);
+  const [progress, setProgress] = useState(null);
   const fileInputRef = useRef(null);
 
   const handleFileSelect = async (e) => {
     const file = e.target.files[0];
     if (!file) return;
 
-    if (!file.name.endsWith('.csv')) {
-      toast.error('Per favore seleziona un file CSV');
+    if (!/\.(csv|vcf|vcard|zip)$/i.test(file.name)) {
+      toast.error('Per favore seleziona un file CSV, vCard o ZIP');
       return;
     }
 
@@ -31,10 +35,25 @@ export default function ImportModal({ onClose, onImported }) {
       });
 
       if (response.ok) {
-        const data = await response.json();
-        setResults(data);
-        if (data.total_imported > 0) {
-          toast.success(`Importati ${data.total_imported} amici!`);
+        // The import runs in the background: poll the job until it completes or fails
+        const { job_id: jobId, total } = await response.json();
+        setProgress({ processed: 0, total });
+        let job;
+        do {
+          await sleep(POLL_INTERVAL_MS);
+          const jobResponse = await fetch(`${API_URL}/api/imported-friends/import-jobs/${jobId}`, {
+            credentials: 'include'
+          });
+          if (!jobResponse.ok) throw new Error('Import job lookup failed');
+          job = await jobResponse.json();
+          setProgress({ processed: job.processed, total: job.total });
+        } while (job.status !== 'completed' && job.status !== 'failed');
+
+        setResults(job);
+        if (job.status === 'failed') {
+          toast.error(job.error ? `Importazione interrotta: ${job.error}` : 'Importazione interrotta');
+        } else if (job.total_imported > 0) {
+          toast.success(`Importati ${job.total_imported} amici!`);
         }
       } else {
         const error = await response.json();
@@ -44,6 +63,7 @@ export default function ImportModal({ onClose, onImported }) {
       toast.error('Errore durante l\'importazione');
     } finally {
       setUploading(false);
+      setProgress(null);
     }
   };
 
@@ -75,16 +95,17 @@ export default function ImportModal({ onClose, onImported }) {
             <>
               <div className="bg-gradient-to-br from-pink-50 to-purple-50 rounded-2xl p-6 text-center border-2 border-dashed border-pink-200">
                 <FileSpreadsheet className="w-12 h-12 text-pink-400 mx-auto mb-4" />
-                <p className="text-slate-700 font-medium mb-2">Carica il tuo file CSV</p>
+                <p className="text-slate-700 font-medium mb-2">Carica il tuo file CSV, vCard o export ZIP di LinkedIn</p>
                 <p className="text-sm text-slate-500 mb-4">
                   Formato: Nome, Cognome, Città<br />
-                  (opzionali: Email, Telefono)
+                  (opzionali: Email, Telefono)<br />
+                  I contatti LinkedIn e vCard senza indirizzo vengono importati senza città
                 </p>
 
                 <input
                   ref={fileInputRef}
                   type="file"
-                  accept=".csv"
+                  accept=".csv,.vcf,.vcard,.zip"
                   onChange={handleFileSelect}
                   className="hidden"
                   data-testid="csv-file-input"
@@ -101,7 +122,7 @@ export default function ImportModal({ onClose, onImported }) {
                   {uploading ? (
                     <>
                       <RefreshCw className="w-5 h-5 animate-spin" />
-                      Importazione in corso...
+                      {progress ? `Importazione in corso... ${progress.processed}/${progress.total}` : 'Importazione in corso...'}
                     </>
                   ) : (
                     <>
@@ -130,6 +151,9 @@ export default function ImportModal({ onClose, onImported }) {
                 </div>
                 <div>
                   <p className="font-semibold text-green-800">{results.total_imported} amici importati</p>
+                  {results.total_duplicates > 0 && (
+                    <p className="text-sm text-slate-500">{results.total_duplicates} duplicati ignorati</p>
+                  )}
                   {results.total_failed > 0 && (
                     <p className="text-sm text-amber-600">{results.total_failed} righe non importate</p>
                   )}